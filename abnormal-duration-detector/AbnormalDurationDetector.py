@@ -16,17 +16,18 @@
 
 import os
 import logging
-import redis
-import redis_lock
 import time
-from bson.son import SON
 import numpy as np
-from sklearn.linear_model import LogisticRegression
 import pickle
 import random
+from ModelCache import publish_models
+from ModelCodec import encode_model, decode_model, is_encoded_model
 
 logger = logging.getLogger()
 
+FEATURE_FIELDS = ("bytes_sent", "bytes_received", "http_status", "duration")
+TRAINING_CURSOR_BATCH_SIZE = 10000
+
 if 'ABNORMAL_DURATION_MIN_SECS' in os.environ:
     abnormal_duration_min_msecs = float(os.environ['ABNORMAL_DURATION_MIN_SECS'])
 else:
@@ -46,55 +47,84 @@ class AbnormalDurationDetector:
         logger.info('Initializing anomaly detector.')
         self.namespace = 'abnormal-duration-detector'
 
-    def training_thread(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
+    def enqueue_untrained(self, aggregates_collection, redis_client, training_queue):
+        # Catch-all for aggregates over the threshold that no scorer queued, e.g. while none was running
+        aggregates = [(aggregate['_id'], aggregate['count']) for aggregate in aggregates_collection.find({ "count": { "$gt": 1000 } }, { "count": 1 })]
+        pipeline = redis_client.pipeline(transaction=False)
+        for id, count in aggregates:
+            pipeline.exists(self.namespace + '/' + id)
+        untrained = { id: count for (id, count), exists in zip(aggregates, pipeline.execute()) if id and not exists }
+        training_queue.request(untrained)
+        logger.info("Queued %d aggregates without a model.", len(untrained))
+
+    def train_queued(self, aggregates_collection, redis_client, training_queue, training_leases, training_pool, cpu_budget):
+        queued = training_queue.prioritized(training_leases, time.time())
+        if not queued:
+            return
+        # Requests made right after a training are dropped, the scorers repeat them if still relevant
+        recently_trained = training_leases.recently_trained(queued)
+        training_queue.done(list(recently_trained))
+        pending = [id for id in queued if id not in recently_trained]
+        spent = 0
+        chunk_size = training_pool.size() * 4
+        for chunk_start in range(0, len(pending), chunk_size):
+            if spent >= cpu_budget:
+                logger.info("Training CPU budget used, %d aggregates left queued.", len(pending) - chunk_start)
+                break
+            chunk = pending[chunk_start:chunk_start + chunk_size]
+            counts = { aggregate['_id']: aggregate['count'] for aggregate in aggregates_collection.find({ "_id": { "$in": chunk } }, { "count": 1 }) }
+            training_queue.done([id for id in chunk if counts.get(id, 0) <= 1000])
+            # Aggregates leased by another trainer stay queued until it is done with them
+            claimed = [(id, counts[id]) for id in chunk if counts.get(id, 0) > 1000 and training_leases.claim(id)]
+            if claimed:
+                spent += self.train_claimed(claimed, redis_client, training_queue, training_leases, training_pool)
+
+    def train_claimed(self, claimed, redis_client, training_queue, training_leases, training_pool):
+        spent = 0
         try:
-            with redis_lock.Lock(redis_client, name=self.namespace + "/train_mutex", expire=1800, auto_renewal=True):
-                self.do_train(http_records_collection, anomalies_collection, samples_collection, redis_client)
-        except redis.exceptions.LockError:
-            logger.info("Could not acquire lock for training.")
-            time.sleep(15)
-
-    def do_train(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
-        logger.info("train_aggregates():")
-        now = int(time.time())
-        pipeline = [
-            { "$match": { "timestamp": { "$gte": now - 3600, "$lt": now } } },
-            { "$group": {"_id": "$aggregate_id", "count": {"$sum": 1} } }
-        ]
-        last_training_annomalies = {}
-        for aggregated_anomaly in anomalies_collection.aggregate(pipeline, allowDiskUse=True):
-            last_training_annomalies[aggregated_anomaly.get('_id')] = aggregated_anomaly.get('count')
-        pipeline = [
-            {"$group": {"_id": "$aggregate_id", "count": {"$sum": 1}}},
-            {"$sort": SON([("count", -1), ("_id", -1)])}
-        ]
-        for aggregate in http_records_collection.aggregate(pipeline, allowDiskUse=True):
-            id = aggregate['_id']
-            count = aggregate['count']
-            model = redis_client.get(self.namespace + '/' + id)
-            if id and count > 1000 and (last_training_annomalies.get(id, 0) > 10 or not model):
-                sample_percentage = 1000 / count
-                chunk_range = int(sample_percentage * 65535)
-                chunk_start = random.randint(0, int((1 - sample_percentage) * 65535))
-                chunk_end = chunk_start + chunk_range
-                samples_collection.delete_many({ "aggregate_id": id })
-                training_data = []
-                for http_record in http_records_collection.find({ "aggregate_id": id, "random": { "$gte": chunk_start, "$lte": chunk_end } }):
-                    line = self.prepare_data(http_record)
-                    training_data.append(line)
-                    samples_collection.insert_one(http_record)
-                training_data = np.array(training_data)
-                logger.info("Training aggregated path '%s' with %d samples", id, training_data.shape[0])
-                model = LogisticRegression()
-                model.fit(training_data[:,0:3],training_data[:,3])
-                redis_client.set(self.namespace + '/' + id, pickle.dumps(model))
-
-    def is_anomalous(self, redis_client, data):
+            recently_trained = training_leases.recently_trained([id for id, count in claimed])
+            models = []
+            for id, serialized_model, cpu_time in training_pool.train([item for item in claimed if item[0] not in recently_trained]):
+                spent += cpu_time
+                if serialized_model:
+                    models.append((id, serialized_model))
+            publish_models(redis_client, self.namespace, models)
+            training_leases.trained([id for id, serialized_model in models])
+            # Failures are not retried, the sweep queues them again while they have no model
+            training_queue.done([id for id, count in claimed])
+        finally:
+            for id, count in claimed:
+                training_leases.release(id)
+        return spent
+
+    def train_aggregate(self, http_records_collection, samples_collection, sample_reservoir, id, count):
+        records = sample_reservoir.load(id)
+        if records.shape[0] < sample_reservoir.size // 2:
+            # Reservoir still filling up, e.g. right after deployment
+            records = self.sample_records(http_records_collection, id, count)
+        # The sample is kept as a single document with the raw feature values
+        samples_collection.delete_many({ "aggregate_id": id })
+        samples_collection.insert_one({ "aggregate_id": id,
+                                        "timestamp": int(time.time()),
+                                        "fields": list(FEATURE_FIELDS),
+                                        "rows": records.shape[0],
+                                        "data": records.tobytes() })
+        training_data = self.prepare_array(records)
+        logger.info("Training aggregated path '%s' with %d samples", id, training_data.shape[0])
+        model = self.new_model()
+        model.fit(training_data[:,0:3],training_data[:,3])
+        model.feature_means = training_data.mean(axis=0)
+        model.feature_stds = training_data.std(axis=0)
+        return model.encode()
+
+    def new_model(self):
+        return DurationModel()
+
+    def is_anomalous(self, model_cache, training_triggers, data):
         aggregate_id = data.get('aggregate_id')
         if aggregate_id:
-            serialized_model = redis_client.get(self.namespace + '/' + aggregate_id)
-            if serialized_model:
-                model = pickle.loads(serialized_model)
+            model = model_cache.get(aggregate_id)
+            if model is not None:
                 data_to_evaluate = np.array([self.prepare_data(data)])
                 expected_result = data_to_evaluate[:,3][0]
                 result = model.predict(data_to_evaluate[:,0:3])[0]
@@ -102,9 +132,46 @@ class AbnormalDurationDetector:
                 logger.info("Request took %d ms and the predicted as %d", expected_result, result)
                 if  difference > abnormal_duration_min_msecs and (difference / expected_result) > abnormal_duration_min_percentage:
                     logger.info("Request was considered anomalous!", expected_result, result)
+                    training_triggers.observe(aggregate_id, model_cache.version(aggregate_id), model, data_to_evaluate, 1)
                     return True
+                training_triggers.observe(aggregate_id, model_cache.version(aggregate_id), model, data_to_evaluate, 0)
+            else:
+                training_triggers.missing_model(aggregate_id, 1)
         return False
 
+    def evaluate_batch(self, model_cache, training_triggers, records):
+        results = [False] * len(records)
+        for aggregate_id, positions in self.group_by_aggregate(records).items():
+            model = model_cache.get(aggregate_id)
+            if model is not None:
+                data_to_evaluate = self.prepare_batch([records[position] for position in positions])
+                expected_results = data_to_evaluate[:,3]
+                predictions = model.predict(data_to_evaluate[:,0:3])
+                differences = np.abs(expected_results - predictions)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    anomalous = (differences > abnormal_duration_min_msecs) & (differences / expected_results > abnormal_duration_min_percentage)
+                training_triggers.observe(aggregate_id, model_cache.version(aggregate_id), model, data_to_evaluate, np.count_nonzero(anomalous))
+                for position, expected_result, result, is_anomalous in zip(positions, expected_results, predictions, anomalous):
+                    if is_anomalous:
+                        logger.info("Request took %d ms and the predicted as %d, considered anomalous!", expected_result, result)
+                        results[position] = True
+            else:
+                training_triggers.missing_model(aggregate_id, len(positions))
+        return results
+
+    def group_by_aggregate(self, records):
+        groups = {}
+        for position, data in enumerate(records):
+            aggregate_id = data.get('aggregate_id')
+            if aggregate_id:
+                groups.setdefault(aggregate_id, []).append(position)
+        return groups
+
+    def deserialize_model(self, serialized_model):
+        if is_encoded_model(serialized_model):
+            return DurationModel.decode(serialized_model)
+        return pickle.loads(serialized_model) # Stored before the compact format, until retrained
+
     def prepare_data(self, data):
         kbytes_sent = float(data.get("bytes_sent", 0))         / 1024
         kbytes_received = float(data.get("bytes_received", 0)) / 1024
@@ -117,3 +184,88 @@ class AbnormalDurationDetector:
             duration
         ]
         return processed_data
+
+    def sample_records(self, http_records_collection, id, count):
+        sample_percentage = 1000 / count
+        chunk_range = int(sample_percentage * 65535)
+        chunk_start = random.randint(0, int((1 - sample_percentage) * 65535))
+        chunk_end = chunk_start + chunk_range
+        return self.load_records(http_records_collection,
+                                 { "aggregate_id": id, "random": { "$gte": chunk_start, "$lte": chunk_end } },
+                                 1000)
+
+    def load_records(self, http_records_collection, query, expected):
+        # Only the feature fields are fetched, straight into a preallocated array
+        records = np.empty((int(expected * 1.25) + 16, len(FEATURE_FIELDS)))
+        size = 0
+        projection = { field: 1 for field in FEATURE_FIELDS }
+        projection['_id'] = 0
+        for http_record in http_records_collection.find(query, projection, batch_size=TRAINING_CURSOR_BATCH_SIZE):
+            if size == records.shape[0]:
+                records = np.concatenate((records, np.empty_like(records)))
+            records[size] = [http_record.get(field, 0) for field in FEATURE_FIELDS]
+            size += 1
+        return records[:size]
+
+    def prepare_batch(self, records):
+        return self.prepare_array(np.array([[data.get(field, 0) for field in FEATURE_FIELDS] for data in records], dtype=float))
+
+    def prepare_array(self, processed_data):
+        processed_data = processed_data / [1024, 1024, 100, 1]
+        processed_data[:, 3] = np.trunc(processed_data[:, 3])
+        return processed_data
+
+
+#
+# Linear regression of the log duration over the bytes sent and received,
+# with one indicator per HTTP status seen in training. The prediction is the
+# typical duration of a request and its cost does not depend on how spread
+# the durations are. Fitting on the log scale keeps the slow outliers present
+# in the training window from dragging the prediction up.
+#
+# Takes the same features as the former LogisticRegression models, so
+# pickled models already stored in Redis keep working until retrained.
+#
+class DurationModel:
+
+    kind = 'log-duration-ridge'
+
+    def __init__(self):
+        # Mean and standard deviation of the training features, for drift detection
+        self.feature_means = None
+        self.feature_stds = None
+
+    @classmethod
+    def decode(cls, serialized_model):
+        kind, arrays, attributes = decode_model(serialized_model)
+        if kind != cls.kind:
+            raise ValueError('Unexpected model kind: %s' % kind)
+        model = cls()
+        model.http_statuses = arrays['http_statuses']
+        model.coefficients = arrays['coefficients']
+        model.intercept = attributes['intercept']
+        model.feature_means = arrays.get('feature_means')
+        model.feature_stds = arrays.get('feature_stds')
+        return model
+
+    def encode(self):
+        arrays = { 'http_statuses': self.http_statuses, 'coefficients': self.coefficients }
+        if self.feature_means is not None:
+            arrays['feature_means'] = self.feature_means
+            arrays['feature_stds'] = self.feature_stds
+        return encode_model(self.kind, arrays, intercept=float(self.intercept))
+
+    def fit(self, features, durations):
+        from sklearn.linear_model import Ridge # Only trainers load sklearn
+        self.http_statuses = np.unique(features[:,2])
+        regression = Ridge(alpha=1.0)
+        regression.fit(self.expand(features), np.log1p(np.maximum(durations, 0)))
+        self.coefficients = regression.coef_
+        self.intercept = regression.intercept_
+        return self
+
+    def predict(self, features):
+        return np.expm1(self.expand(features) @ self.coefficients + self.intercept)
+
+    def expand(self, features):
+        return np.hstack((features[:,0:2], features[:,2:3] == self.http_statuses))
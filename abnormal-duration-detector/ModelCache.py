@@ -0,0 +1,163 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+
+def model_key(namespace, aggregate_id):
+    return namespace + '/' + aggregate_id
+
+
+def version_key(namespace, aggregate_id):
+    return namespace + '/version/' + aggregate_id
+
+
+def updates_channel(namespace):
+    return namespace + '/model_updates'
+
+
+def models_key(namespace):
+    return namespace + '/models'
+
+
+def publish_models(redis_client, namespace, models):
+    # Models, generation stamps, index and invalidations are written in a single MULTI/EXEC
+    if not models:
+        return
+    pipeline = redis_client.pipeline()
+    for aggregate_id, serialized_model in models:
+        pipeline.set(model_key(namespace, aggregate_id), serialized_model)
+        pipeline.incr(version_key(namespace, aggregate_id))
+        pipeline.sadd(models_key(namespace), aggregate_id)
+        pipeline.publish(updates_channel(namespace), aggregate_id)
+    pipeline.execute()
+
+
+#
+# Bounded LRU cache of deserialized models, keyed by aggregate_id.
+#
+# Entries are dropped as soon as an update is announced on the namespace
+# channel. As a fallback for lost notifications, positive entries are
+# revalidated against the generation stamp after 'ttl' seconds and
+# negative entries (aggregates without a model) expire after 'negative_ttl'.
+#
+# On startup, warm_up loads the models listed in the namespace 'models' index
+# set, so the first records of every aggregate do not all go to Redis.
+#
+class ModelCache:
+
+    def __init__(self, redis_client, namespace, deserialize, max_size=10000, ttl=60, negative_ttl=30):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.deserialize = deserialize
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, aggregate_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(aggregate_id)
+            if entry:
+                self.entries.move_to_end(aggregate_id)
+        if entry:
+            model, version, checked_at = entry
+            if model is None:
+                if now - checked_at < self.negative_ttl:
+                    return None
+            elif now - checked_at < self.ttl:
+                return model
+            elif self.redis_client.get(version_key(self.namespace, aggregate_id)) == version:
+                self.put(aggregate_id, model, version, now)
+                return model
+        return self.load(aggregate_id, now)
+
+    def load(self, aggregate_id, now):
+        serialized_model, version = self.redis_client.mget(model_key(self.namespace, aggregate_id),
+                                                           version_key(self.namespace, aggregate_id))
+        model = self.deserialize(serialized_model) if serialized_model else None
+        self.put(aggregate_id, model, version, now)
+        return model
+
+    def put(self, aggregate_id, model, version, now):
+        with self.lock:
+            self.entries[aggregate_id] = (model, version, now)
+            self.entries.move_to_end(aggregate_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def model_ids(self):
+        aggregate_ids = self.redis_client.smembers(models_key(self.namespace))
+        if not aggregate_ids:
+            # Models published before the index was kept all have a generation stamp
+            prefix = version_key(self.namespace, '').encode()
+            aggregate_ids = { key[len(prefix):] for key in self.redis_client.scan_iter(match=prefix + b'*', count=1000) }
+            if aggregate_ids:
+                self.redis_client.sadd(models_key(self.namespace), *aggregate_ids)
+        return [aggregate_id.decode() for aggregate_id in aggregate_ids]
+
+    def warm_up(self, deadline, accept=None, batch_size=500):
+        aggregate_ids = [aggregate_id for aggregate_id in self.model_ids() if accept is None or accept(aggregate_id)][:self.max_size]
+        loaded = 0
+        for batch_start in range(0, len(aggregate_ids), batch_size):
+            if time.monotonic() > deadline:
+                logger.info('Model cache warm up deadline reached, %d models not loaded.', len(aggregate_ids) - batch_start)
+                break
+            batch = aggregate_ids[batch_start:batch_start + batch_size]
+            keys = []
+            for aggregate_id in batch:
+                keys.append(model_key(self.namespace, aggregate_id))
+                keys.append(version_key(self.namespace, aggregate_id))
+            values = self.redis_client.mget(keys)
+            now = time.monotonic()
+            for aggregate_id, serialized_model, version in zip(batch, values[0::2], values[1::2]):
+                if serialized_model:
+                    try:
+                        self.put(aggregate_id, self.deserialize(serialized_model), version, now)
+                        loaded += 1
+                    except:
+                        logger.exception("Failure loading model of aggregated path '%s'.", aggregate_id)
+        return loaded
+
+    def version(self, aggregate_id):
+        # Generation stamp of the cached model, so callers need not hold on to the model itself
+        with self.lock:
+            entry = self.entries.get(aggregate_id)
+        return entry[1] if entry else None
+
+    def invalidate(self, aggregate_id):
+        with self.lock:
+            self.entries.pop(aggregate_id, None)
+
+    def size(self):
+        return len(self.entries)
+
+    def listen(self):
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(updates_channel(self.namespace))
+        logger.info('Listening for model updates on %s', updates_channel(self.namespace))
+        for message in pubsub.listen():
+            aggregate_id = message.get('data')
+            if isinstance(aggregate_id, bytes):
+                aggregate_id = aggregate_id.decode()
+            self.invalidate(aggregate_id)
@@ -0,0 +1,62 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import struct
+import numpy as np
+
+MAGIC = b'KOM1'
+HEADER_LENGTH = struct.Struct('<I')
+ARRAY_DTYPE = np.dtype('<f8')
+
+#
+# Compact model format stored in Redis:
+#
+#   'KOM1' | header length (uint32) | JSON header | raw float64 arrays
+#
+# The header holds the model kind, its scalar attributes and the name and
+# shape of each array. Arrays are read with np.frombuffer, without copying
+# and without depending on the library that fitted the model.
+#
+
+def encode_model(kind, arrays, **attributes):
+    header = { 'kind': kind, 'attributes': attributes, 'arrays': [] }
+    blobs = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=ARRAY_DTYPE)
+        header['arrays'].append({ 'name': name, 'shape': list(array.shape) })
+        blobs.append(array.tobytes())
+    header = json.dumps(header, separators=(',', ':')).encode()
+    return MAGIC + HEADER_LENGTH.pack(len(header)) + header + b''.join(blobs)
+
+
+def is_encoded_model(payload):
+    return payload[:len(MAGIC)] == MAGIC
+
+
+def decode_model(payload):
+    offset = len(MAGIC)
+    header_length, = HEADER_LENGTH.unpack_from(payload, offset)
+    offset += HEADER_LENGTH.size
+    header = json.loads(payload[offset:offset + header_length])
+    offset += header_length
+    arrays = {}
+    for array in header.get('arrays'):
+        shape = tuple(array.get('shape'))
+        count = int(np.prod(shape))
+        arrays[array.get('name')] = np.frombuffer(payload, dtype=ARRAY_DTYPE, count=count, offset=offset).reshape(shape)
+        offset += count * ARRAY_DTYPE.itemsize
+    return header.get('kind'), arrays, header.get('attributes')
@@ -0,0 +1,127 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import heapq
+import logging
+import math
+import random
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+#
+# Bounded, time decayed reservoir of recent feature vectors per aggregate,
+# filled by the scorers as records stream past, so training does not have to
+# sample the http_records collection.
+#
+# Each record gets the priority 'decay * t - ln(E)', E ~ Exp(1), and the
+# 'size' highest priorities are kept in a Redis sorted set. This is weighted
+# reservoir sampling with weights exp(decay * t): a record is half as likely
+# to be kept as one arriving 'half_life' seconds later, whatever the
+# retention or the traffic of the aggregate.
+#
+# Candidates are buffered in memory, keeping only the best 'size' per
+# aggregate, and written with one pipeline per flush. Records that would not
+# enter a full reservoir are discarded before reaching Redis. The entry
+# thresholds are kept for at most 'max_aggregates' aggregates, least recently
+# flushed first out, and dropped once the Redis key would have expired.
+#
+class SampleReservoir:
+
+    def __init__(self, redis_client, namespace, fields, size=1000, half_life=86400, max_aggregates=10000):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.fields = fields
+        self.size = size
+        self.decay = math.log(2) / half_life
+        self.expire = int(half_life * 10) # Weights of older records are below 0.1%
+        self.record_dtype = np.dtype('<f8')
+        self.record_width = len(fields) + 1 # Features and a random tag, so equal records are kept apart
+        self.max_aggregates = max_aggregates
+        self.pending = {}
+        self.thresholds = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, aggregate_id):
+        return self.namespace + '/reservoir/' + aggregate_id
+
+    def add(self, records):
+        now = time.time()
+        with self.lock:
+            for data in records:
+                aggregate_id = data.get('aggregate_id')
+                if not aggregate_id:
+                    continue
+                priority = self.decay * now - math.log(random.expovariate(1) or 1e-300)
+                if priority <= self.threshold(aggregate_id, now):
+                    continue
+                candidates = self.pending.setdefault(aggregate_id, [])
+                if len(candidates) < self.size:
+                    heapq.heappush(candidates, (priority, self.encode(data)))
+                elif priority > candidates[0][0]:
+                    heapq.heapreplace(candidates, (priority, self.encode(data)))
+
+    def encode(self, data):
+        values = [float(data.get(field, 0)) for field in self.fields]
+        values.append(random.random())
+        return np.array(values, dtype=self.record_dtype).tobytes()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if not pending:
+            return
+        # Samples lost on a failed flush are not retried, newer records replace them
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for aggregate_id, candidates in pending.items():
+            key = self.key(aggregate_id)
+            pipeline.zadd(key, { member: priority for priority, member in candidates })
+            pipeline.zremrangebyrank(key, 0, -self.size - 1)
+            pipeline.expire(key, self.expire)
+            pipeline.zrange(key, -self.size, -self.size, withscores=True)
+        results = pipeline.execute()
+        expires_at = time.time() + self.expire
+        with self.lock:
+            for aggregate_id, lowest in zip(pending, results[3::4]):
+                # Only set once the reservoir is full
+                if lowest:
+                    self.thresholds[aggregate_id] = (lowest[0][1], expires_at)
+                    self.thresholds.move_to_end(aggregate_id)
+            while len(self.thresholds) > self.max_aggregates:
+                self.thresholds.popitem(last=False)
+        logger.debug('Flushed reservoir candidates of %d aggregates.', len(pending))
+
+    def threshold(self, aggregate_id, now):
+        entry = self.thresholds.get(aggregate_id)
+        if entry is None:
+            return -math.inf
+        if entry[1] < now:
+            del self.thresholds[aggregate_id]
+            return -math.inf
+        return entry[0]
+
+    def is_full(self, aggregate_id):
+        with self.lock:
+            return self.threshold(aggregate_id, time.time()) > -math.inf
+
+    def load(self, aggregate_id):
+        members = self.redis_client.zrange(self.key(aggregate_id), 0, -1)
+        records = np.frombuffer(b''.join(members), dtype=self.record_dtype).reshape(-1, self.record_width)
+        return records[:, :len(self.fields)]
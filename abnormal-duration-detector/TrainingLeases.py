@@ -0,0 +1,75 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import uuid
+
+logger = logging.getLogger()
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+#
+# Per aggregate training leases, so several replicas share a training sweep.
+#
+# A replica claims an aggregate with SET NX EX before training it and records
+# when it was trained in the namespace 'trained_at' hash. Aggregates trained
+# by any replica within the training interval are skipped, and the lease of
+# a replica that died expires after 'expire' seconds so another one picks the
+# aggregate up.
+#
+class TrainingLeases:
+
+    def __init__(self, redis_client, namespace, expire=300, training_interval=3600):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.expire = expire
+        self.training_interval = training_interval
+        self.owner = str(uuid.uuid4())
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    def lease_key(self, aggregate_id):
+        return self.namespace + '/train_lease/' + aggregate_id
+
+    def trained_at_key(self):
+        return self.namespace + '/trained_at'
+
+    def claim(self, aggregate_id):
+        return bool(self.redis_client.set(self.lease_key(aggregate_id), self.owner, nx=True, ex=self.expire))
+
+    def release(self, aggregate_id):
+        self.release_script(keys=[self.lease_key(aggregate_id)], args=[self.owner])
+
+    def trained(self, aggregate_ids):
+        if aggregate_ids:
+            now = int(time.time())
+            self.redis_client.hset(self.trained_at_key(), mapping={ aggregate_id: now for aggregate_id in aggregate_ids })
+
+    def trained_at(self, aggregate_ids):
+        if not aggregate_ids:
+            return []
+        return [float(timestamp) if timestamp else None
+                for timestamp in self.redis_client.hmget(self.trained_at_key(), aggregate_ids)]
+
+    def recently_trained(self, aggregate_ids):
+        trained_after = time.time() - self.training_interval
+        return { aggregate_id for aggregate_id, timestamp in zip(aggregate_ids, self.trained_at(aggregate_ids))
+                 if timestamp and timestamp > trained_after }
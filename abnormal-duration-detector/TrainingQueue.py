@@ -0,0 +1,64 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import math
+
+logger = logging.getLogger()
+
+#
+# Aggregates waiting to be trained, kept in the namespace 'training_queue'
+# sorted set with the traffic seen since they were queued as score.
+#
+# Scorers queue an aggregate when its reservoir fills up without a model,
+# when its anomaly rate is too high or when its features drift away from the
+# training data. Trainers take the queue ordered by traffic and by how long
+# ago the current model was trained, 'staleness' seconds of age doubling the
+# priority of a given traffic. Aggregates never trained come first.
+#
+class TrainingQueue:
+
+    def __init__(self, redis_client, namespace, staleness=3600):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.staleness = staleness
+
+    def key(self):
+        return self.namespace + '/training_queue'
+
+    def request(self, requests):
+        if requests:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for aggregate_id, traffic in requests.items():
+                pipeline.zincrby(self.key(), traffic, aggregate_id)
+            pipeline.execute()
+
+    def done(self, aggregate_ids):
+        if aggregate_ids:
+            self.redis_client.zrem(self.key(), *aggregate_ids)
+
+    def size(self):
+        return self.redis_client.zcard(self.key())
+
+    def prioritized(self, training_leases, now):
+        queued = [(aggregate_id.decode(), traffic) for aggregate_id, traffic in self.redis_client.zrange(self.key(), 0, -1, withscores=True)]
+        trained_at = training_leases.trained_at([aggregate_id for aggregate_id, traffic in queued])
+        def priority(item):
+            (aggregate_id, traffic), timestamp = item
+            if timestamp is None:
+                return (1, traffic)
+            return (0, math.log1p(traffic) * (1 + max(now - timestamp, 0) / self.staleness))
+        return [aggregate_id for (aggregate_id, traffic), timestamp in sorted(zip(queued, trained_at), key=priority, reverse=True)]
@@ -0,0 +1,75 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Training and scoring cost of the duration model against the former
+# multiclass LogisticRegression, on synthetic records.
+#
+# Usage: python benchmark-duration-model.py [samples] [spread_ms]
+#
+
+import sys
+import time
+import pickle
+import warnings
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from AbnormalDurationDetector import AbnormalDurationDetector
+
+
+def synthetic_records(count, spread, rng):
+    bytes_sent = rng.integers(100, 20000, count)
+    bytes_received = rng.integers(100, 200000, count)
+    http_status = rng.choice([200, 201, 404, 500], count, p=[0.8, 0.1, 0.07, 0.03])
+    duration = 5 + bytes_received / 2000 + rng.gamma(2.0, spread / 20, count)
+    duration[http_status == 500] += spread / 2
+    return [{ "bytes_sent": int(s), "bytes_received": int(r), "http_status": int(h), "duration": int(d) }
+            for s, r, h, d in zip(bytes_sent, bytes_received, http_status, duration)]
+
+
+def measure(name, model, detector, training_data, records):
+    started = time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model.fit(training_data[:,0:3], training_data[:,3])
+    training = time.perf_counter() - started
+    size = len(model.encode() if hasattr(model, 'encode') else pickle.dumps(model))
+
+    started = time.perf_counter()
+    for data in records[:200]:
+        model.predict(np.array([detector.prepare_data(data)])[:,0:3])
+    single = (time.perf_counter() - started) / 200
+
+    batch = detector.prepare_batch(records)
+    started = time.perf_counter()
+    predictions = model.predict(batch[:,0:3])
+    batched = (time.perf_counter() - started) / len(records)
+    error = np.median(np.abs(predictions - batch[:,3]))
+
+    print('%-20s fit %8.1f ms, model %9d bytes, predict %8.1f us/record single, %6.2f us/record batched, median error %7.1f ms' % (
+        name, training * 1e3, size, single * 1e6, batched * 1e6, error))
+
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    spread = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = np.random.default_rng(0)
+    detector = AbnormalDurationDetector()
+    training_data = np.array([detector.prepare_data(data) for data in synthetic_records(samples, spread, rng)])
+    records = synthetic_records(5000, spread, rng)
+    print('%d training samples, %d distinct durations' % (samples, len(np.unique(training_data[:,3]))))
+    measure('LogisticRegression', LogisticRegression(), detector, training_data, records)
+    measure('DurationModel', detector.new_model(), detector, training_data, records)
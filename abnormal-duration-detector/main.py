@@ -22,11 +22,20 @@ import threading
 import pika
 import json
 import uuid
+import zlib
 from pymongo import MongoClient
-from AbnormalDurationDetector import AbnormalDurationDetector
+from AbnormalDurationDetector import AbnormalDurationDetector, FEATURE_FIELDS
+from ModelCache import ModelCache
+from TrainingLeases import TrainingLeases
+from TrainingPool import TrainingPool
+from TrainingQueue import TrainingQueue
+from TrainingTriggers import TrainingTriggers
+from SampleReservoir import SampleReservoir
+from RollupCounters import RollupCounters
 import redis
 from flask import Flask
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Histogram, Gauge
 
 
 logger = logging.getLogger()
@@ -37,6 +46,17 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s -
 logger.addHandler(handler)
 
 
+if 'DETECTOR_ROLE' in os.environ:
+    detector_role = os.environ['DETECTOR_ROLE']
+else:
+    detector_role = 'both'
+if detector_role not in ('scorer', 'trainer', 'both'):
+    logger.fatal('Invalid DETECTOR_ROLE: %s (expected scorer, trainer or both).', detector_role)
+    sys.exit()
+logger.info('Detector role: %s', detector_role)
+scorer_role = detector_role in ('scorer', 'both')
+trainer_role = detector_role in ('trainer', 'both')
+
 if 'REDIS_HOST' in os.environ:
     redis_host = os.environ['REDIS_HOST']
 else:
@@ -66,12 +86,30 @@ else:
     mongo_http_records = 'http_records'
 logger.info('HTTP records collection is: %s', mongo_http_records)
 
+if 'MONGO_AGGREGATES' in os.environ:
+    mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+    mongo_aggregates = 'aggregates'
+logger.info('Aggregates collection is: %s', mongo_aggregates)
+
 if 'MONGO_ANOMALIES' in os.environ:
     mongo_anomalies = os.environ['MONGO_ANOMALIES']
 else:
     mongo_anomalies = "anomalies"
 logger.info('Anomalies collection is: %s', mongo_anomalies)
 
+if 'MONGO_ROLLUPS' in os.environ:
+    mongo_rollups = os.environ['MONGO_ROLLUPS']
+else:
+    mongo_rollups = 'rollups'
+logger.info('Rollups collection is: %s', mongo_rollups)
+
+if 'ROLLUPS_FLUSH_INTERVAL' in os.environ:
+    rollups_flush_interval = int(os.environ['ROLLUPS_FLUSH_INTERVAL'])
+else:
+    rollups_flush_interval = 5
+logger.info('Rollup counters flush interval: %d seconds', rollups_flush_interval)
+
 if 'MONGO_SAMPLES' in os.environ:
     mongo_samples = os.environ['MONGO_SAMPLES']
 else:
@@ -91,26 +129,179 @@ else:
     rabbitmq_exchange = "http_enriched_records"
 logger.info('RabbitMQ exchange: %s', rabbitmq_exchange)
 
+if 'RABBITMQ_ANOMALIES_EXCHANGE' in os.environ:
+    rabbitmq_anomalies_exchange = os.environ['RABBITMQ_ANOMALIES_EXCHANGE']
+else:
+    rabbitmq_anomalies_exchange = "anomalies"
+logger.info('RabbitMQ anomalies exchange: %s', rabbitmq_anomalies_exchange)
+
 if 'RABBITMQ_QUEUE' in os.environ:
     rabbitmq_queue = os.environ['RABBITMQ_QUEUE']
 else:
     rabbitmq_queue = 'abnormal_duration_detector'
 logger.info('RabbitMQ queue: %s', rabbitmq_queue)
 
+if 'RABBITMQ_SHARDS' in os.environ:
+    rabbitmq_shards = int(os.environ['RABBITMQ_SHARDS'])
+else:
+    rabbitmq_shards = 64
+logger.info('RabbitMQ routing key shards: %d', rabbitmq_shards)
+
+if 'DETECTOR_SHARD_COUNT' in os.environ:
+    detector_shard_count = int(os.environ['DETECTOR_SHARD_COUNT'])
+else:
+    detector_shard_count = 1
+if 'DETECTOR_SHARD_INDEX' in os.environ:
+    detector_shard_index = int(os.environ['DETECTOR_SHARD_INDEX'])
+else:
+    detector_shard_index = 0
+if not 0 <= detector_shard_index < detector_shard_count:
+    logger.fatal('Invalid DETECTOR_SHARD_INDEX: %d (expected 0 to %d).', detector_shard_index, detector_shard_count - 1)
+    sys.exit()
+if detector_shard_count > 1:
+    # Replicas of the same shard share its queue, changing the shard count leaves the former queues behind
+    rabbitmq_queue = '%s.%d-of-%d' % (rabbitmq_queue, detector_shard_index, detector_shard_count)
+    logger.info('Detector shard: %d of %d, consuming from %s', detector_shard_index, detector_shard_count, rabbitmq_queue)
+
+if 'MODEL_CACHE_SIZE' in os.environ:
+    model_cache_size = int(os.environ['MODEL_CACHE_SIZE'])
+else:
+    model_cache_size = 10000
+logger.info('Model cache size: %d models', model_cache_size)
+
+if 'MODEL_CACHE_TTL' in os.environ:
+    model_cache_ttl = int(os.environ['MODEL_CACHE_TTL'])
+else:
+    model_cache_ttl = 60
+logger.info('Model cache revalidation interval: %d seconds', model_cache_ttl)
+
+if 'MODEL_CACHE_NEGATIVE_TTL' in os.environ:
+    model_cache_negative_ttl = int(os.environ['MODEL_CACHE_NEGATIVE_TTL'])
+else:
+    model_cache_negative_ttl = 30
+logger.info('Model cache negative entries expiration: %d seconds', model_cache_negative_ttl)
+
+if 'MODEL_CACHE_WARM_UP_TIMEOUT' in os.environ:
+    model_cache_warm_up_timeout = int(os.environ['MODEL_CACHE_WARM_UP_TIMEOUT'])
+else:
+    model_cache_warm_up_timeout = 60
+logger.info('Model cache warm up timeout: %d seconds', model_cache_warm_up_timeout)
+
+if 'BATCH_SIZE' in os.environ:
+    batch_size = int(os.environ['BATCH_SIZE'])
+else:
+    batch_size = 1
+logger.info('Evaluation batch size: %d records', batch_size)
+
+if 'BATCH_TIMEOUT_MS' in os.environ:
+    batch_timeout = float(os.environ['BATCH_TIMEOUT_MS']) / 1000
+else:
+    batch_timeout = 0.1
+logger.info('Evaluation batch timeout: %d milliseconds', batch_timeout * 1000)
+
+if 'TRAINING_INTERVAL' in os.environ:
+    training_interval = int(os.environ['TRAINING_INTERVAL'])
+else:
+    training_interval = 3600
+logger.info('Training interval: %d seconds', training_interval)
+
+if 'TRAINING_CYCLE' in os.environ:
+    training_cycle = int(os.environ['TRAINING_CYCLE'])
+else:
+    training_cycle = 60
+logger.info('Training queue cycle: %d seconds', training_cycle)
+
+if 'TRAINING_CPU_BUDGET' in os.environ:
+    training_cpu_budget = float(os.environ['TRAINING_CPU_BUDGET'])
+else:
+    training_cpu_budget = 30
+logger.info('Training CPU budget: %d seconds per cycle', training_cpu_budget)
+
+if 'TRAINING_MIN_INTERVAL' in os.environ:
+    training_min_interval = int(os.environ['TRAINING_MIN_INTERVAL'])
+else:
+    training_min_interval = 600
+logger.info('Minimum interval between trainings of an aggregate: %d seconds', training_min_interval)
+
+if 'TRAINING_ANOMALY_RATE' in os.environ:
+    training_anomaly_rate = float(os.environ['TRAINING_ANOMALY_RATE'])
+else:
+    training_anomaly_rate = 0.01
+logger.info('Retraining above anomaly rate: %.4f', training_anomaly_rate)
+
+if 'TRAINING_DRIFT' in os.environ:
+    training_drift = float(os.environ['TRAINING_DRIFT'])
+else:
+    training_drift = 0.5
+logger.info('Retraining above feature drift: %.2f standard deviations', training_drift)
+
+if 'TRAINING_DRIFT_MIN_RECORDS' in os.environ:
+    training_drift_min_records = int(os.environ['TRAINING_DRIFT_MIN_RECORDS'])
+else:
+    training_drift_min_records = 200
+logger.info('Minimum records per anomaly rate and drift window: %d', training_drift_min_records)
+
+if 'TRAINING_LEASE_SECONDS' in os.environ:
+    training_lease_seconds = int(os.environ['TRAINING_LEASE_SECONDS'])
+else:
+    training_lease_seconds = 300
+logger.info('Training lease expiration: %d seconds', training_lease_seconds)
+
+if 'TRAINING_WORKERS' in os.environ:
+    training_workers = int(os.environ['TRAINING_WORKERS'])
+else:
+    training_workers = 1
+logger.info('Training worker processes: %d', training_workers)
+
+if 'SAMPLE_RESERVOIR_SIZE' in os.environ:
+    sample_reservoir_size = int(os.environ['SAMPLE_RESERVOIR_SIZE'])
+else:
+    sample_reservoir_size = 1000
+logger.info('Training sample reservoir size: %d records', sample_reservoir_size)
+
+if 'SAMPLE_RESERVOIR_HALF_LIFE' in os.environ:
+    sample_reservoir_half_life = int(os.environ['SAMPLE_RESERVOIR_HALF_LIFE'])
+else:
+    sample_reservoir_half_life = 86400
+logger.info('Training sample reservoir half-life: %d seconds', sample_reservoir_half_life)
+
+if 'SAMPLE_RESERVOIR_FLUSH_INTERVAL' in os.environ:
+    sample_reservoir_flush_interval = int(os.environ['SAMPLE_RESERVOIR_FLUSH_INTERVAL'])
+else:
+    sample_reservoir_flush_interval = 5
+logger.info('Training sample reservoir flush interval: %d seconds', sample_reservoir_flush_interval)
+
 
 service_ok = False
 records_processed = 0
+rollup_counters = RollupCounters()
+model_cache_warm = threading.Event()
+model_cache_warm_up_deadline = time.monotonic() + model_cache_warm_up_timeout
 flask_app = Flask(__name__)
 metrics = PrometheusMetrics(flask_app)
 counter = metrics.info('evaluated_records', 'Number of evaluated records')
 counter.set(0)
 anomaly_counter = metrics.info('abnormal_records', 'Number of abnormal records')
 anomaly_counter.set(0)
+batch_size_histogram = Histogram('evaluation_batch_size',
+                                 'Number of records evaluated per batch.',
+                                 buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+batch_latency_histogram = Histogram('evaluation_batch_latency_seconds',
+                                    'Time from the first record of a batch being received to the batch being acknowledged.')
+model_size_histogram = Histogram('model_payload_bytes',
+                                 'Size of the models loaded from Redis.',
+                                 buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+model_load_histogram = Histogram('model_load_seconds',
+                                 'Time to decode a model loaded from Redis.',
+                                 buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+warm_up_duration_gauge = Gauge('model_cache_warm_up_seconds', 'Time taken to preload the models at startup.')
+warm_up_models_gauge = Gauge('model_cache_warm_up_models', 'Number of models preloaded at startup.')
 
 @flask_app.route('/healthcheck')
 @metrics.do_not_track()
 def healthcheck():
-    if service_ok:
+    # Scorers only report healthy once their models are loaded, or the warm up took too long
+    if service_ok and (not scorer_role or model_cache_warm.is_set() or time.monotonic() > model_cache_warm_up_deadline):
         return 'OK', 200
     else:
         return 'NOK', 400
@@ -119,18 +310,55 @@ def healthcheck():
 detector = AbnormalDurationDetector()
 
 
-# Create indexes
-client = MongoClient(mongo_url)
-database = client[mongo_database]
-http_recors_collection = database[mongo_http_records]
-http_recors_collection.create_index([("aggregate_id", 1)])
-http_recors_collection.create_index([("aggregate_id", 1), ("random", 1)])
-http_recors_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
-anomalies_collection = database[mongo_anomalies]
-anomalies_collection.create_index([("aggregate_id", 1)])
-anomalies_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
-samples_collection = database[mongo_samples]
-samples_collection.create_index([("aggregate_id", 1)])
+def deserialize_model(serialized_model):
+    started = time.perf_counter()
+    model = detector.deserialize_model(serialized_model)
+    model_load_histogram.observe(time.perf_counter() - started)
+    model_size_histogram.observe(len(serialized_model))
+    return model
+
+
+model_cache = ModelCache(redis.Redis(host=redis_host, port=int(redis_port), db=0),
+                         detector.namespace,
+                         deserialize_model,
+                         max_size=model_cache_size,
+                         ttl=model_cache_ttl,
+                         negative_ttl=model_cache_negative_ttl)
+
+sample_reservoir = SampleReservoir(redis.Redis(host=redis_host, port=int(redis_port), db=0),
+                                   detector.namespace,
+                                   FEATURE_FIELDS,
+                                   size=sample_reservoir_size,
+                                   half_life=sample_reservoir_half_life,
+                                   max_aggregates=model_cache_size)
+
+training_queue = TrainingQueue(redis.Redis(host=redis_host, port=int(redis_port), db=0),
+                               detector.namespace,
+                               staleness=training_interval)
+
+training_triggers = TrainingTriggers(training_queue,
+                                     sample_reservoir,
+                                     anomaly_rate=training_anomaly_rate,
+                                     drift=training_drift,
+                                     min_records=training_drift_min_records,
+                                     max_windows=model_cache_size)
+
+
+def create_indexes():
+    client = MongoClient(mongo_url)
+    database = client[mongo_database]
+    http_recors_collection = database[mongo_http_records]
+    http_recors_collection.create_index([("aggregate_id", 1)])
+    http_recors_collection.create_index([("aggregate_id", 1), ("random", 1)])
+    http_recors_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
+    aggregates_collection = database[mongo_aggregates]
+    aggregates_collection.create_index([("count", -1), ("_id", -1)])
+    anomalies_collection = database[mongo_anomalies]
+    anomalies_collection.create_index([("aggregate_id", 1)])
+    anomalies_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
+    samples_collection = database[mongo_samples]
+    samples_collection.create_index([("aggregate_id", 1)])
+    client.close()
 
 
 def run_trainer():
@@ -139,33 +367,143 @@ def run_trainer():
         try:
             client = MongoClient(mongo_url)
             database = client[mongo_database]
-            http_records_collection = database[mongo_http_records]
-            anomalies_collection = database[mongo_anomalies]
-            samples_collection = database[mongo_samples]
+            aggregates_collection = database[mongo_aggregates]
             redis_client = redis.Redis(host=redis_host, port=int(redis_port), db=0)
+            training_leases = TrainingLeases(redis_client, detector.namespace, training_lease_seconds, training_min_interval)
             service_ok = True
+            next_sweep = time.monotonic()
             while True:
-                detector.training_thread(http_records_collection, anomalies_collection, samples_collection, redis_client)
-                time.sleep(3600)
+                if time.monotonic() >= next_sweep:
+                    detector.enqueue_untrained(aggregates_collection, redis_client, training_queue)
+                    next_sweep = time.monotonic() + training_interval
+                detector.train_queued(aggregates_collection, redis_client, training_queue, training_leases, training_pool, training_cpu_budget)
+                time.sleep(training_cycle)
         except:
             service_ok = False
             logger.exception("Failure at training thread.")
             time.sleep(15)
 
 
-def evaluate_message(anomalies_collection, redis_client, data):
-    global counter, records_processed
-    if detector.is_anomalous(redis_client, data):
-        anomaly_counter.inc()
+def publish_anomalies(channel, anomalies):
+    # Only what the streaming reporter counts, it is not persisted
+    for data in anomalies:
+        event = { "aggregate_id": data.get('aggregate_id'), "anomaly": data.get('anomaly'), "timestamp": data.get('timestamp') }
+        channel.basic_publish(exchange=rabbitmq_anomalies_exchange, routing_key='', body=json.dumps(event))
+
+
+# Malformed records, as opposed to failures of Redis or MongoDB, which are retried
+RECORD_ERRORS = (AttributeError, KeyError, TypeError, ValueError)
+
+
+def parse_record(body):
+    try:
+        data = json.loads(body)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+    logger.error('Discarding record that could not be parsed: %s', body[:1024])
+    return None
+
+
+def evaluate_records(records):
+    # Whether each record is anomalous, None for the records that could not be evaluated
+    try:
+        return detector.evaluate_batch(model_cache, training_triggers, records)
+    except RECORD_ERRORS:
+        if len(records) == 1:
+            logger.exception('Discarding record that could not be evaluated: %s', json.dumps(records[0]))
+            return [None]
+    # A single malformed record fails the whole batch, the others are evaluated on their own
+    return [result for data in records for result in evaluate_records([data])]
+
+
+def evaluate_message(channel, anomalies_collection, data):
+    [is_anomalous] = evaluate_records([data])
+    if is_anomalous is None:
+        return
+    if is_anomalous:
         data['_id'] = str(uuid.uuid4())
         data['anomaly'] = 'abnormal-duration-detector'
         anomalies_collection.insert_one(data)
-    counter.inc()
-    records_processed += 1
+        publish_anomalies(channel, [data])
+    record_evaluated([data], [data] if is_anomalous else [])
+
+
+def evaluate_batch(channel, anomalies_collection, deliveries):
+    records = []
+    anomalies = []
+    for (delivery_tag, data), is_anomalous in zip(deliveries, evaluate_records([data for delivery_tag, data in deliveries])):
+        if is_anomalous is None:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            continue
+        records.append(data)
+        last_delivery_tag = delivery_tag
+        if is_anomalous:
+            data['_id'] = str(uuid.uuid4())
+            data['anomaly'] = 'abnormal-duration-detector'
+            anomalies.append(data)
+    if anomalies:
+        anomalies_collection.insert_many(anomalies)
+        publish_anomalies(channel, anomalies)
+    if records:
+        channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+    record_evaluated(records, anomalies)
+
+
+def record_evaluated(records, anomalies):
+    # Only once acknowledged, so a batch redelivered after a failure is not counted twice
+    global counter, records_processed
+    sample_reservoir.add(records)
+    for data in anomalies:
+        rollup_counters.add(data['aggregate_id'], data.get('timestamp', time.time()), 'anomalies.' + data['anomaly'])
+    anomaly_counter.inc(len(anomalies))
+    counter.inc(len(records))
+    records_processed += len(records)
+
+
+def consume_batches(channel, anomalies_collection):
+    channel.basic_qos(prefetch_count=batch_size)
+    deliveries = []
+    for method, properties, body in channel.consume(queue=rabbitmq_queue, inactivity_timeout=batch_timeout):
+        if method:
+            data = parse_record(body)
+            if data is None:
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            else:
+                if not deliveries:
+                    batch_started = time.monotonic()
+                deliveries.append((method.delivery_tag, data))
+        if deliveries and (len(deliveries) >= batch_size or time.monotonic() - batch_started >= batch_timeout):
+            evaluate_batch(channel, anomalies_collection, deliveries)
+            batch_size_histogram.observe(len(deliveries))
+            batch_latency_histogram.observe(time.monotonic() - batch_started)
+            deliveries = []
+
+
+def owns_aggregate(aggregate_id):
+    # Same routing key as computed by enrichment
+    return zlib.crc32(aggregate_id.encode()) % rabbitmq_shards % detector_shard_count == detector_shard_index
+
+
+def declare_queue(channel):
+    channel.exchange_declare(exchange = rabbitmq_anomalies_exchange, exchange_type = 'fanout')
+    channel.queue_declare(queue = rabbitmq_queue, exclusive = False)
+    if detector_shard_count > 1:
+        # Only the routing keys of this shard, through a direct exchange fed by the fanout one
+        sharded_exchange = rabbitmq_exchange + '.sharded'
+        channel.exchange_declare(exchange = rabbitmq_exchange, exchange_type = 'fanout')
+        channel.exchange_declare(exchange = sharded_exchange, exchange_type = 'direct')
+        channel.exchange_bind(destination = sharded_exchange, source = rabbitmq_exchange)
+        for shard in range(detector_shard_index, rabbitmq_shards, detector_shard_count):
+            channel.queue_bind(exchange = sharded_exchange, queue = rabbitmq_queue, routing_key = str(shard))
+    else:
+        channel.queue_bind(exchange = rabbitmq_exchange, queue = rabbitmq_queue)
 
 
 def run_queue_listener():
     global service_ok
+    model_cache_warm.wait(max(model_cache_warm_up_deadline - time.monotonic(), 0))
     while True:
 
         connected = False
@@ -173,27 +511,83 @@ def run_queue_listener():
             try:
                 connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
                 channel = connection.channel()
-                channel.queue_declare(queue = rabbitmq_queue, exclusive = False)
-                channel.queue_bind(exchange = rabbitmq_exchange, queue = rabbitmq_queue)
+                declare_queue(channel)
                 connected = True
             except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosedByBroker):
                 logger.info('Waiting before retrying RabbitMQ connection...')
                 time.sleep(15)
 
+        client = None
         try:
             client = MongoClient(mongo_url)
             database = client[mongo_database]
             anomalies_collection = database[mongo_anomalies]
-            redis_client = redis.Redis(host=redis_host, port=int(redis_port), db=0)
-            def callback(channel, method, properties, body):
-                data = json.loads(body)
-                evaluate_message(anomalies_collection, redis_client, data)
-            channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
-            service_ok = True
-            channel.start_consuming()
+            if batch_size > 1:
+                service_ok = True
+                consume_batches(channel, anomalies_collection)
+            else:
+                def callback(channel, method, properties, body):
+                    data = parse_record(body)
+                    if data is not None:
+                        evaluate_message(channel, anomalies_collection, data)
+                channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
+                service_ok = True
+                channel.start_consuming()
         except:
             service_ok = False
             logger.exception("Failure evaluating records.")
+            # Unacknowledged deliveries are only requeued once the old connection is gone
+            try:
+                connection.close()
+            except:
+                pass
+            if client:
+                client.close()
+            time.sleep(15)
+
+
+def run_model_cache_warm_up():
+    started = time.monotonic()
+    try:
+        loaded = model_cache.warm_up(model_cache_warm_up_deadline, owns_aggregate)
+        warm_up_duration_gauge.set(time.monotonic() - started)
+        warm_up_models_gauge.set(loaded)
+        logger.info('Model cache warm up loaded %d models in %.1f seconds.', loaded, time.monotonic() - started)
+    except:
+        logger.exception("Failure warming up the model cache.")
+    model_cache_warm.set()
+
+
+def run_model_cache_listener():
+    while True:
+        try:
+            model_cache.listen()
+        except:
+            logger.exception("Failure listening for model updates.")
+            time.sleep(15)
+
+
+def run_training_data_flush():
+    while True:
+        time.sleep(sample_reservoir_flush_interval)
+        try:
+            sample_reservoir.flush()
+            training_triggers.flush()
+        except:
+            logger.exception("Failure flushing training samples and requests.")
+
+
+def run_rollups_flush():
+    while True:
+        try:
+            client = MongoClient(mongo_url)
+            database = client[mongo_database]
+            rollups_collection = database[mongo_rollups]
+            while True:
+                time.sleep(rollups_flush_interval)
+                rollup_counters.flush(rollups_collection)
+        except:
+            logger.exception("Failure updating rollup counters.")
             time.sleep(15)
 
 
@@ -203,18 +597,30 @@ def run_report_records_processed():
         if records_processed > 0:
             count = records_processed
             records_processed -= count
-            logger.info("%d records evaluated during last minute.", count)
+            logger.info("%d records evaluated during last minute (%d models cached).", count, model_cache.size())
         time.sleep(60)
 
 
 if __name__ == "__main__":
     try:
-        training_thread = threading.Thread(target=run_trainer)
-        training_thread.start()
-        report_records_processed_thread = threading.Thread(target=run_report_records_processed)
-        report_records_processed_thread.start()
-        queue_listener_thread=threading.Thread(target=run_queue_listener)
-        queue_listener_thread.start()
+        if trainer_role:
+            create_indexes()
+            training_pool = TrainingPool(training_workers, detector, mongo_url, mongo_database, mongo_http_records, mongo_samples, sample_reservoir)
+            training_thread = threading.Thread(target=run_trainer)
+            training_thread.start()
+        if scorer_role:
+            report_records_processed_thread = threading.Thread(target=run_report_records_processed)
+            report_records_processed_thread.start()
+            rollups_flush_thread = threading.Thread(target=run_rollups_flush)
+            rollups_flush_thread.start()
+            model_cache_listener_thread = threading.Thread(target=run_model_cache_listener)
+            model_cache_listener_thread.start()
+            model_cache_warm_up_thread = threading.Thread(target=run_model_cache_warm_up)
+            model_cache_warm_up_thread.start()
+            training_data_flush_thread = threading.Thread(target=run_training_data_flush)
+            training_data_flush_thread.start()
+            queue_listener_thread=threading.Thread(target=run_queue_listener)
+            queue_listener_thread.start()
         flask_app.run(host='0.0.0.0', port=80)
     except (IOError, SystemExit):
         raise
@@ -16,104 +16,112 @@
 
 import os
 import logging
-import redis
-import redis_lock
+import math
 import time
-from bson.son import SON
-import numpy as np
-from sklearn.linear_model import LogisticRegression
-import pickle
-import random
+from collections import OrderedDict
 
 logger = logging.getLogger()
 
-if 'ABNORMAL_DURATION_MIN_SECS' in os.environ:
-    abnormal_duration_min_msecs = float(os.environ['ABNORMAL_DURATION_MIN_SECS'])
+if 'ABNORMAL_STATUS_HALF_LIFE' in os.environ:
+    abnormal_status_half_life = float(os.environ['ABNORMAL_STATUS_HALF_LIFE'])
 else:
-    abnormal_duration_min_msecs = 5
-logger.info('Minimal abnormal duration difference in milliseconds to consider as anomaly: %s milliseconds', abnormal_duration_min_msecs)
+    abnormal_status_half_life = 3600
+logger.info('Status counters half-life: %s seconds', abnormal_status_half_life)
 
-if 'ABNORMAL_DURATION_MIN_PERCENTAGE' in os.environ:
-    abnormal_duration_min_percentage = float(os.environ['ABNORMAL_DURATION_MIN_PERCENTAGE'])
+if 'ABNORMAL_STATUS_MAX_PROBABILITY' in os.environ:
+    abnormal_status_max_probability = float(os.environ['ABNORMAL_STATUS_MAX_PROBABILITY'])
 else:
-    abnormal_duration_min_percentage = 5.0
-logger.info('Minimal abnormal duration difference in percentage to consider as anomaly: %s %', abnormal_duration_min_percentage)
-abnormal_duration_min_percentage %= 100
+    abnormal_status_max_probability = 0.01
+logger.info('Maximal status class probability to consider as anomaly: %s', abnormal_status_max_probability)
 
-class AbnormalDurationDetector:
+if 'ABNORMAL_STATUS_MIN_WEIGHT' in os.environ:
+    abnormal_status_min_weight = float(os.environ['ABNORMAL_STATUS_MIN_WEIGHT'])
+else:
+    abnormal_status_min_weight = 100
+logger.info('Minimal decayed number of requests before evaluating an aggregate: %s', abnormal_status_min_weight)
+
+if 'ABNORMAL_STATUS_MAX_AGGREGATES' in os.environ:
+    abnormal_status_max_aggregates = int(os.environ['ABNORMAL_STATUS_MAX_AGGREGATES'])
+else:
+    abnormal_status_max_aggregates = 100000
+logger.info('Maximal number of aggregates tracked: %d', abnormal_status_max_aggregates)
+
+STATUS_CLASSES = 6   # 1xx to 5xx, anything else in the last slot
+PRIOR_WEIGHT = 0.5   # Additive smoothing, so unseen classes are rare but not impossible
+
+#
+# Streaming status detector.
+#
+# Keeps, per aggregate_id, exponentially decayed counters of the HTTP status
+# classes seen, and flags a request when the probability of its status class
+# on that endpoint is below ABNORMAL_STATUS_MAX_PROBABILITY. Each request is
+# scored against the counters before being added to them, so both cost a
+# constant number of operations and no model has to be trained.
+#
+# Counters live in memory and are rebuilt from the stream after a restart,
+# aggregates are only evaluated once their decayed weight reaches
+# ABNORMAL_STATUS_MIN_WEIGHT.
+#
+class AbnormalStatusDetector:
 
     def __init__(self):
         logger.info('Initializing anomaly detector.')
-        self.namespace = 'abnormal-duration-detector'
+        self.namespace = 'abnormal-status-detector'
+        self.decay_rate = math.log(2) / abnormal_status_half_life
+        self.counters = OrderedDict()
 
-    def training_thread(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
-        try:
-            with redis_lock.Lock(redis_client, name=self.namespace + "/train_mutex", expire=1800, auto_renewal=True):
-                self.do_train(http_records_collection, anomalies_collection, samples_collection, redis_client)
-        except redis.exceptions.LockError:
-            logger.info("Could not acquire lock for training.")
-            time.sleep(15)
-
-    def do_train(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
-        logger.info("train_aggregates():")
-        now = int(time.time())
-        pipeline = [
-            { "$match": { "timestamp": { "$gte": now - 3600, "$lt": now } } },
-            { "$group": {"_id": "$aggregate_id", "count": {"$sum": 1} } }
-        ]
-        last_training_annomalies = {}
-        for aggregated_anomaly in anomalies_collection.aggregate(pipeline, allowDiskUse=True):
-            last_training_annomalies[aggregated_anomaly.get('_id')] = aggregated_anomaly.get('count')
-        pipeline = [
-            {"$group": {"_id": "$aggregate_id", "count": {"$sum": 1}}},
-            {"$sort": SON([("count", -1), ("_id", -1)])}
-        ]
-        for aggregate in http_records_collection.aggregate(pipeline, allowDiskUse=True):
-            id = aggregate['_id']
-            count = aggregate['count']
-            model = redis_client.get(self.namespace + '/' + id)
-            if id and count > 1000 and (last_training_annomalies.get(id, 0) > 10 or not model):
-                sample_percentage = 1000 / count
-                chunk_range = int(sample_percentage * 65535)
-                chunk_start = random.randint(0, int((1 - sample_percentage) * 65535))
-                chunk_end = chunk_start + chunk_range
-                samples_collection.delete_many({ "aggregate_id": id })
-                training_data = []
-                for http_record in http_records_collection.find({ "aggregate_id": id, "random": { "$gte": chunk_start, "$lte": chunk_end } }):
-                    line = self.prepare_data(http_record)
-                    training_data.append(line)
-                    samples_collection.insert_one(http_record)
-                training_data = np.array(training_data)
-                logger.info("Training aggregated path '%s' with %d samples", id, training_data.shape[0])
-                model = LogisticRegression()
-                model.fit(training_data[:,0:3],training_data[:,3])
-                redis_client.set(self.namespace + '/' + id, pickle.dumps(model))
-
-    def is_anomalous(self, redis_client, data):
+    def is_anomalous(self, data):
         aggregate_id = data.get('aggregate_id')
         if aggregate_id:
-            serialized_model = redis_client.get(self.namespace + '/' + aggregate_id)
-            if serialized_model:
-                model = pickle.loads(serialized_model)
-                data_to_evaluate = np.array([self.prepare_data(data)])
-                expected_result = data_to_evaluate[:,3][0]
-                result = model.predict(data_to_evaluate[:,0:3])[0]
-                difference = abs(expected_result - result)
-                logger.info("Request took %d ms and the predicted as %d", expected_result, result)
-                if  difference > abnormal_duration_min_msecs and (difference / expected_result) > abnormal_duration_min_percentage:
-                    logger.info("Request was considered anomalous!", expected_result, result)
-                    return True
+            return self.update(aggregate_id, self.status_class(data), self.timestamp(data))
         return False
 
-    def prepare_data(self, data):
-        kbytes_sent = float(data.get("bytes_sent", 0))         / 1024
-        kbytes_received = float(data.get("bytes_received", 0)) / 1024
-        http_status = float(data.get("http_status", 0))        / 100
-        duration = int(data.get("duration", 0))
-        processed_data = [
-            kbytes_sent,
-            kbytes_received,
-            http_status,
-            duration
-        ]
-        return processed_data
+    def evaluate_batch(self, records):
+        return [self.is_anomalous(data) for data in records]
+
+    def update(self, aggregate_id, status_class, timestamp):
+        counters = self.counters.get(aggregate_id)
+        if counters is None:
+            counters = [0.0] * STATUS_CLASSES + [timestamp]
+            self.counters[aggregate_id] = counters
+            while len(self.counters) > abnormal_status_max_aggregates:
+                self.counters.popitem(last=False)
+        else:
+            self.counters.move_to_end(aggregate_id)
+            self.decay(counters, timestamp)
+        total = sum(counters[0:STATUS_CLASSES])
+        anomalous = False
+        if total >= abnormal_status_min_weight:
+            probability = (counters[status_class] + PRIOR_WEIGHT) / (total + PRIOR_WEIGHT * STATUS_CLASSES)
+            if probability < abnormal_status_max_probability:
+                logger.info("Status class %dxx has probability %.4f on '%s', considered anomalous!",
+                            status_class + 1, probability, aggregate_id)
+                anomalous = True
+        counters[status_class] += 1
+        return anomalous
+
+    def decay(self, counters, timestamp):
+        elapsed = timestamp - counters[STATUS_CLASSES]
+        if elapsed > 0:
+            factor = math.exp(-self.decay_rate * elapsed)
+            for status_class in range(STATUS_CLASSES):
+                counters[status_class] *= factor
+            counters[STATUS_CLASSES] = timestamp
+
+    def size(self):
+        return len(self.counters)
+
+    def status_class(self, data):
+        try:
+            status_class = int(data.get("http_status", 0)) // 100 - 1
+        except (TypeError, ValueError):
+            status_class = -1
+        if 0 <= status_class < STATUS_CLASSES - 1:
+            return status_class
+        return STATUS_CLASSES - 1
+
+    def timestamp(self, data):
+        try:
+            return float(data.get("timestamp"))
+        except (TypeError, ValueError):
+            return time.time()
@@ -0,0 +1,70 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import datetime
+import logging
+import threading
+from pymongo import UpdateOne
+
+logger = logging.getLogger()
+
+#
+# Per minute counters of each aggregate_id, one document per aggregate and
+# minute in the rollups collection:
+#
+#   { "_id": "<aggregate_id>/<minute>", "aggregate_id": ..., "minute": ...,
+#     "records": ..., "anomalies": { "<anomaly>": ... } }
+#
+# Enrichment counts the records and every detector its anomalies, so the
+# reporter sums a few documents per endpoint instead of scanning the raw
+# records. Minutes come from the record timestamps. Counts are accumulated
+# in memory and written with one bulk $inc per flush.
+#
+class RollupCounters:
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, aggregate_id, timestamp, counter, count=1):
+        minute = int(timestamp) // 60 * 60
+        with self.lock:
+            counters = self.counts.setdefault((aggregate_id, minute), {})
+            counters[counter] = counters.get(counter, 0) + count
+
+    def flush(self, collection):
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        if not counts:
+            return
+        created_at = datetime.datetime.now(datetime.timezone.utc) # Expiration is based on it
+        operations = [UpdateOne({ "_id": '%s/%d' % (aggregate_id, minute) },
+                                { "$inc": counters,
+                                  "$setOnInsert": { "aggregate_id": aggregate_id, "minute": minute, "created_at": created_at } },
+                                upsert=True)
+                      for (aggregate_id, minute), counters in counts.items()]
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except:
+            # Retried on the next flush, a partially applied bulk may be counted twice
+            with self.lock:
+                for key, counters in counts.items():
+                    current = self.counts.setdefault(key, {})
+                    for counter, count in counters.items():
+                        current[counter] = current.get(counter, 0) + count
+            raise
+        logger.debug('Updated %d rollup documents.', len(operations))
@@ -22,11 +22,13 @@ import threading
 import pika
 import json
 import uuid
+import zlib
 from pymongo import MongoClient
 from AbnormalStatusDetector import AbnormalStatusDetector
-import redis
+from RollupCounters import RollupCounters
 from flask import Flask
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Histogram
 
 
 logger = logging.getLogger()
@@ -37,16 +39,6 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s -
 logger.addHandler(handler)
 
 
-if 'REDIS_HOST' in os.environ:
-    redis_host = os.environ['REDIS_HOST']
-else:
-    redis_host = 'localhost'
-if 'REDIS_PORT' in os.environ:
-    redis_port = os.environ['REDIS_PORT']
-else:
-    redis_port = '6379'
-logger.info('Using Redis at: %s:%s', redis_host, redis_port)
-
 if 'MONGO_URL' in os.environ:
     mongo_url = os.environ['MONGO_URL']
     logger.info('Using mongo URL: %s', mongo_url)
@@ -60,23 +52,23 @@ else:
     mongo_database = 'kubeowl'
 logger.info('Using mongo database: %s', mongo_database)
 
-if 'MONGO_HTTP_RECORDS' in os.environ:
-    mongo_http_records = os.environ['MONGO_HTTP_RECORDS']
-else:
-    mongo_http_records = 'http_records'
-logger.info('HTTP records collection is: %s', mongo_http_records)
-
 if 'MONGO_ANOMALIES' in os.environ:
     mongo_anomalies = os.environ['MONGO_ANOMALIES']
 else:
     mongo_anomalies = "anomalies"
 logger.info('Anomalies collection is: %s', mongo_anomalies)
 
-if 'MONGO_SAMPLES' in os.environ:
-    mongo_samples = os.environ['MONGO_SAMPLES']
+if 'MONGO_ROLLUPS' in os.environ:
+    mongo_rollups = os.environ['MONGO_ROLLUPS']
+else:
+    mongo_rollups = 'rollups'
+logger.info('Rollups collection is: %s', mongo_rollups)
+
+if 'ROLLUPS_FLUSH_INTERVAL' in os.environ:
+    rollups_flush_interval = int(os.environ['ROLLUPS_FLUSH_INTERVAL'])
 else:
-    mongo_samples = "abnormal-duration-samples"
-logger.info('Samples collection is: %s', mongo_samples)
+    rollups_flush_interval = 5
+logger.info('Rollup counters flush interval: %d seconds', rollups_flush_interval)
 
 if 'RABBITMQ_HOST' in os.environ:
     rabbitmq_host = os.environ['RABBITMQ_HOST']
@@ -91,21 +83,67 @@ else:
     rabbitmq_exchange = "http_enriched_records"
 logger.info('RabbitMQ exchange: %s', rabbitmq_exchange)
 
+if 'RABBITMQ_ANOMALIES_EXCHANGE' in os.environ:
+    rabbitmq_anomalies_exchange = os.environ['RABBITMQ_ANOMALIES_EXCHANGE']
+else:
+    rabbitmq_anomalies_exchange = "anomalies"
+logger.info('RabbitMQ anomalies exchange: %s', rabbitmq_anomalies_exchange)
+
 if 'RABBITMQ_QUEUE' in os.environ:
     rabbitmq_queue = os.environ['RABBITMQ_QUEUE']
 else:
-    rabbitmq_queue = 'abnormal_duration_detector'
+    rabbitmq_queue = 'abnormal_status_detector'
 logger.info('RabbitMQ queue: %s', rabbitmq_queue)
 
+if 'RABBITMQ_SHARDS' in os.environ:
+    rabbitmq_shards = int(os.environ['RABBITMQ_SHARDS'])
+else:
+    rabbitmq_shards = 64
+logger.info('RabbitMQ routing key shards: %d', rabbitmq_shards)
+
+if 'DETECTOR_SHARD_COUNT' in os.environ:
+    detector_shard_count = int(os.environ['DETECTOR_SHARD_COUNT'])
+else:
+    detector_shard_count = 1
+if 'DETECTOR_SHARD_INDEX' in os.environ:
+    detector_shard_index = int(os.environ['DETECTOR_SHARD_INDEX'])
+else:
+    detector_shard_index = 0
+if not 0 <= detector_shard_index < detector_shard_count:
+    logger.fatal('Invalid DETECTOR_SHARD_INDEX: %d (expected 0 to %d).', detector_shard_index, detector_shard_count - 1)
+    sys.exit()
+if detector_shard_count > 1:
+    # Replicas of the same shard share its queue, changing the shard count leaves the former queues behind
+    rabbitmq_queue = '%s.%d-of-%d' % (rabbitmq_queue, detector_shard_index, detector_shard_count)
+    logger.info('Detector shard: %d of %d, consuming from %s', detector_shard_index, detector_shard_count, rabbitmq_queue)
+
+if 'BATCH_SIZE' in os.environ:
+    batch_size = int(os.environ['BATCH_SIZE'])
+else:
+    batch_size = 1
+logger.info('Evaluation batch size: %d records', batch_size)
+
+if 'BATCH_TIMEOUT_MS' in os.environ:
+    batch_timeout = float(os.environ['BATCH_TIMEOUT_MS']) / 1000
+else:
+    batch_timeout = 0.1
+logger.info('Evaluation batch timeout: %d milliseconds', batch_timeout * 1000)
+
 
 service_ok = False
 records_processed = 0
+rollup_counters = RollupCounters()
 flask_app = Flask(__name__)
 metrics = PrometheusMetrics(flask_app)
 counter = metrics.info('evaluated_records', 'Number of evaluated records')
 counter.set(0)
 anomaly_counter = metrics.info('abnormal_records', 'Number of abnormal records')
 anomaly_counter.set(0)
+batch_size_histogram = Histogram('evaluation_batch_size',
+                                 'Number of records evaluated per batch.',
+                                 buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+batch_latency_histogram = Histogram('evaluation_batch_latency_seconds',
+                                    'Time from the first record of a batch being received to the batch being acknowledged.')
 
 @flask_app.route('/healthcheck')
 @metrics.do_not_track()
@@ -122,47 +160,125 @@ detector = AbnormalStatusDetector()
 # Create indexes
 client = MongoClient(mongo_url)
 database = client[mongo_database]
-http_recors_collection = database[mongo_http_records]
-http_recors_collection.create_index([("aggregate_id", 1)])
-http_recors_collection.create_index([("aggregate_id", 1), ("random", 1)])
-http_recors_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
 anomalies_collection = database[mongo_anomalies]
 anomalies_collection.create_index([("aggregate_id", 1)])
 anomalies_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
-samples_collection = database[mongo_samples]
-samples_collection.create_index([("aggregate_id", 1)])
 
 
-def run_trainer():
-    global service_ok
-    while True:
-        try:
-            global client, database, anomalies_collection, samples_collection
-            client = MongoClient(mongo_url)
-            database = client[mongo_database]
-            http_records_collection = database[mongo_http_records]
-            anomalies_collection = database[mongo_anomalies]
-            samples_collection = database[mongo_samples]
-            redis_client = redis.Redis(host=redis_host, port=int(redis_port), db=0)
-            service_ok = True
-            while True:
-                detector.training_thread(http_records_collection, anomalies_collection, samples_collection, redis_client)
-                time.sleep(3600)
-        except:
-            service_ok = False
-            logger.exception("Failure at training thread.")
-            time.sleep(15)
+def publish_anomalies(channel, anomalies):
+    # Only what the streaming reporter counts, it is not persisted
+    for data in anomalies:
+        event = { "aggregate_id": data.get('aggregate_id'), "anomaly": data.get('anomaly'), "timestamp": data.get('timestamp') }
+        channel.basic_publish(exchange=rabbitmq_anomalies_exchange, routing_key='', body=json.dumps(event))
 
 
-def evaluate_message(anomalies_collection, redis_client, data):
-    global counter, records_processed
-    if detector.is_anomalous(redis_client, data):
-        anomaly_counter.inc()
+# Malformed records, as opposed to failures of Redis or MongoDB, which are retried
+RECORD_ERRORS = (AttributeError, KeyError, TypeError, ValueError)
+
+
+def parse_record(body):
+    try:
+        data = json.loads(body)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+    logger.error('Discarding record that could not be parsed: %s', body[:1024])
+    return None
+
+
+def evaluate_records(records):
+    # Whether each record is anomalous, None for the records that could not be evaluated
+    results = []
+    for data in records:
+        try:
+            results.append(detector.is_anomalous(data))
+        except RECORD_ERRORS:
+            logger.exception('Discarding record that could not be evaluated: %s', json.dumps(data))
+            results.append(None)
+    return results
+
+
+def evaluate_message(channel, anomalies_collection, data):
+    [is_anomalous] = evaluate_records([data])
+    if is_anomalous is None:
+        return
+    if is_anomalous:
         data['_id'] = str(uuid.uuid4())
-        data['anomaly'] = 'abnormal-duration-detector'
+        data['anomaly'] = detector.namespace
         anomalies_collection.insert_one(data)
-    counter.inc()
-    records_processed += 1
+        publish_anomalies(channel, [data])
+    record_evaluated([data], [data] if is_anomalous else [])
+
+
+def evaluate_batch(channel, anomalies_collection, deliveries):
+    records = []
+    anomalies = []
+    for (delivery_tag, data), is_anomalous in zip(deliveries, evaluate_records([data for delivery_tag, data in deliveries])):
+        if is_anomalous is None:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            continue
+        records.append(data)
+        last_delivery_tag = delivery_tag
+        if is_anomalous:
+            data['_id'] = str(uuid.uuid4())
+            data['anomaly'] = detector.namespace
+            anomalies.append(data)
+    if anomalies:
+        anomalies_collection.insert_many(anomalies)
+        publish_anomalies(channel, anomalies)
+    if records:
+        channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+    record_evaluated(records, anomalies)
+
+
+def record_evaluated(records, anomalies):
+    # Only once acknowledged, so a batch redelivered after a failure is not counted twice
+    global counter, records_processed
+    for data in anomalies:
+        rollup_counters.add(data['aggregate_id'], data.get('timestamp', time.time()), 'anomalies.' + data['anomaly'])
+    anomaly_counter.inc(len(anomalies))
+    counter.inc(len(records))
+    records_processed += len(records)
+
+
+def consume_batches(channel, anomalies_collection):
+    channel.basic_qos(prefetch_count=batch_size)
+    deliveries = []
+    for method, properties, body in channel.consume(queue=rabbitmq_queue, inactivity_timeout=batch_timeout):
+        if method:
+            data = parse_record(body)
+            if data is None:
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            else:
+                if not deliveries:
+                    batch_started = time.monotonic()
+                deliveries.append((method.delivery_tag, data))
+        if deliveries and (len(deliveries) >= batch_size or time.monotonic() - batch_started >= batch_timeout):
+            evaluate_batch(channel, anomalies_collection, deliveries)
+            batch_size_histogram.observe(len(deliveries))
+            batch_latency_histogram.observe(time.monotonic() - batch_started)
+            deliveries = []
+
+
+def owns_aggregate(aggregate_id):
+    # Same routing key as computed by enrichment
+    return zlib.crc32(aggregate_id.encode()) % rabbitmq_shards % detector_shard_count == detector_shard_index
+
+
+def declare_queue(channel):
+    channel.exchange_declare(exchange = rabbitmq_anomalies_exchange, exchange_type = 'fanout')
+    channel.queue_declare(queue = rabbitmq_queue, exclusive = False)
+    if detector_shard_count > 1:
+        # Only the routing keys of this shard, through a direct exchange fed by the fanout one
+        sharded_exchange = rabbitmq_exchange + '.sharded'
+        channel.exchange_declare(exchange = rabbitmq_exchange, exchange_type = 'fanout')
+        channel.exchange_declare(exchange = sharded_exchange, exchange_type = 'direct')
+        channel.exchange_bind(destination = sharded_exchange, source = rabbitmq_exchange)
+        for shard in range(detector_shard_index, rabbitmq_shards, detector_shard_count):
+            channel.queue_bind(exchange = sharded_exchange, queue = rabbitmq_queue, routing_key = str(shard))
+    else:
+        channel.queue_bind(exchange = rabbitmq_exchange, queue = rabbitmq_queue)
 
 
 def run_queue_listener():
@@ -174,27 +290,52 @@ def run_queue_listener():
             try:
                 connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
                 channel = connection.channel()
-                channel.queue_declare(queue = rabbitmq_queue, exclusive = False)
-                channel.queue_bind(exchange = rabbitmq_exchange, queue = rabbitmq_queue)
+                declare_queue(channel)
                 connected = True
             except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosedByBroker):
                 logger.info('Waiting before retrying RabbitMQ connection...')
                 time.sleep(15)
 
+        client = None
         try:
             client = MongoClient(mongo_url)
             database = client[mongo_database]
             anomalies_collection = database[mongo_anomalies]
-            redis_client = redis.Redis(host=redis_host, port=int(redis_port), db=0)
-            def callback(channel, method, properties, body):
-                data = json.loads(body)
-                evaluate_message(anomalies_collection, redis_client, data)
-            channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
-            service_ok = True
-            channel.start_consuming()
+            if batch_size > 1:
+                service_ok = True
+                consume_batches(channel, anomalies_collection)
+            else:
+                def callback(channel, method, properties, body):
+                    data = parse_record(body)
+                    if data is not None:
+                        evaluate_message(channel, anomalies_collection, data)
+                channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
+                service_ok = True
+                channel.start_consuming()
         except:
             service_ok = False
             logger.exception("Failure evaluating records.")
+            # Unacknowledged deliveries are only requeued once the old connection is gone
+            try:
+                connection.close()
+            except:
+                pass
+            if client:
+                client.close()
+            time.sleep(15)
+
+
+def run_rollups_flush():
+    while True:
+        try:
+            client = MongoClient(mongo_url)
+            database = client[mongo_database]
+            rollups_collection = database[mongo_rollups]
+            while True:
+                time.sleep(rollups_flush_interval)
+                rollup_counters.flush(rollups_collection)
+        except:
+            logger.exception("Failure updating rollup counters.")
             time.sleep(15)
 
 
@@ -204,16 +345,16 @@ def run_report_records_processed():
         if records_processed > 0:
             count = records_processed
             records_processed -= count
-            logger.info("%d records evaluated during last minute.", count)
+            logger.info("%d records evaluated during last minute (%d aggregates tracked).", count, detector.size())
         time.sleep(60)
 
 
 if __name__ == "__main__":
     try:
-        training_thread = threading.Thread(target=run_trainer)
-        training_thread.start()
         report_records_processed_thread = threading.Thread(target=run_report_records_processed)
         report_records_processed_thread.start()
+        rollups_flush_thread = threading.Thread(target=run_rollups_flush)
+        rollups_flush_thread.start()
         queue_listener_thread=threading.Thread(target=run_queue_listener)
         queue_listener_thread.start()
         flask_app.run(host='0.0.0.0', port=80)
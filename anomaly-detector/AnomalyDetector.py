@@ -14,79 +14,179 @@
 # limitations under the License.
 #
 
+import os
 import logging
-import redis
-import redis_lock
 import time
-from bson.son import SON
 import numpy as np
-from sklearn import svm
 import pickle
 import random
+from ModelCache import publish_models
+from ModelCodec import encode_model, decode_model, is_encoded_model
 
 logger = logging.getLogger()
 
+FEATURE_FIELDS = ("bytes_sent", "bytes_received", "http_status", "duration")
+TRAINING_CURSOR_BATCH_SIZE = 10000
+
+if 'ANOMALY_MODEL' in os.environ:
+    anomaly_model = os.environ['ANOMALY_MODEL']
+else:
+    anomaly_model = 'exact'
+logger.info('Anomaly model: %s', anomaly_model)
+
+if 'ANOMALY_KERNEL_COMPONENTS' in os.environ:
+    anomaly_kernel_components = int(os.environ['ANOMALY_KERNEL_COMPONENTS'])
+else:
+    anomaly_kernel_components = 64
+logger.info('Kernel approximation components: %d', anomaly_kernel_components)
+
 class AnomalyDetector:
 
     def __init__(self):
         logger.info('Initializing anomaly detector.')
         self.namespace = 'anomaly-detector'
 
-    def training_thread(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
+    def enqueue_untrained(self, aggregates_collection, redis_client, training_queue):
+        # Catch-all for aggregates over the threshold that no scorer queued, e.g. while none was running
+        aggregates = [(aggregate['_id'], aggregate['count']) for aggregate in aggregates_collection.find({ "count": { "$gt": 1000 } }, { "count": 1 })]
+        pipeline = redis_client.pipeline(transaction=False)
+        for id, count in aggregates:
+            pipeline.exists(self.namespace + '/' + id)
+        untrained = { id: count for (id, count), exists in zip(aggregates, pipeline.execute()) if id and not exists }
+        training_queue.request(untrained)
+        logger.info("Queued %d aggregates without a model.", len(untrained))
+
+    def train_queued(self, aggregates_collection, redis_client, training_queue, training_leases, training_pool, cpu_budget):
+        queued = training_queue.prioritized(training_leases, time.time())
+        if not queued:
+            return
+        # Requests made right after a training are dropped, the scorers repeat them if still relevant
+        recently_trained = training_leases.recently_trained(queued)
+        training_queue.done(list(recently_trained))
+        pending = [id for id in queued if id not in recently_trained]
+        spent = 0
+        chunk_size = training_pool.size() * 4
+        for chunk_start in range(0, len(pending), chunk_size):
+            if spent >= cpu_budget:
+                logger.info("Training CPU budget used, %d aggregates left queued.", len(pending) - chunk_start)
+                break
+            chunk = pending[chunk_start:chunk_start + chunk_size]
+            counts = { aggregate['_id']: aggregate['count'] for aggregate in aggregates_collection.find({ "_id": { "$in": chunk } }, { "count": 1 }) }
+            training_queue.done([id for id in chunk if counts.get(id, 0) <= 1000])
+            # Aggregates leased by another trainer stay queued until it is done with them
+            claimed = [(id, counts[id]) for id in chunk if counts.get(id, 0) > 1000 and training_leases.claim(id)]
+            if claimed:
+                spent += self.train_claimed(claimed, redis_client, training_queue, training_leases, training_pool)
+
+    def train_claimed(self, claimed, redis_client, training_queue, training_leases, training_pool):
+        spent = 0
         try:
-            with redis_lock.Lock(redis_client, name=self.namespace + "/train_mutex", expire=1800, auto_renewal=True):
-                self.do_train(http_records_collection, anomalies_collection, samples_collection, redis_client)
-        except redis.exceptions.LockError:
-            logger.info("Could not acquire lock for training.")
-            time.sleep(15)
-
-    def do_train(self, http_records_collection, anomalies_collection, samples_collection, redis_client):
-        logger.info("train_aggregates():")
-        now = int(time.time())
-        pipeline = [
-            { "$match": { "timestamp": { "$gte": now - 3600, "$lt": now } } },
-            { "$group": {"_id": "$aggregate_id", "count": {"$sum": 1} } }
-        ]
-        last_training_annomalies = {}
-        for aggregated_anomaly in anomalies_collection.aggregate(pipeline, allowDiskUse=True):
-            last_training_annomalies[aggregated_anomaly.get('_id')] = aggregated_anomaly.get('count')
-        pipeline = [
-            {"$group": {"_id": "$aggregate_id", "count": {"$sum": 1}}},
-            {"$sort": SON([("count", -1), ("_id", -1)])}
-        ]
-        for aggregate in http_records_collection.aggregate(pipeline, allowDiskUse=True):
-            id = aggregate['_id']
-            count = aggregate['count']
-            model = redis_client.get(self.namespace + '/' + id)
-            if id and count > 1000 and (last_training_annomalies.get(id, 0) > 10 or not model):
-                sample_percentage = 1000 / count
-                chunk_range = int(sample_percentage * 65535)
-                chunk_start = random.randint(0, int((1 - sample_percentage) * 65535))
-                chunk_end = chunk_start + chunk_range
-                samples_collection.delete_many({ "aggregate_id": id })
-                training_data = []
-                for http_record in http_records_collection.find({ "aggregate_id": id, "random": { "$gte": chunk_start, "$lte": chunk_end } }):
-                    line = self.prepare_data(http_record)
-                    training_data.append(line)
-                    samples_collection.insert_one(http_record)
-                training_data = np.matrix(training_data)
-                logger.info("Training aggregated path '%s' with %d samples", id, training_data.shape[0])
-                model = svm.OneClassSVM(nu=0.001, kernel="rbf", gamma='scale')
-                model.fit(training_data)
-                redis_client.set(self.namespace + '/' + id, pickle.dumps(model))
-
-    def is_anomalous(self, redis_client, data):
+            recently_trained = training_leases.recently_trained([id for id, count in claimed])
+            models = []
+            for id, serialized_model, cpu_time in training_pool.train([item for item in claimed if item[0] not in recently_trained]):
+                spent += cpu_time
+                if serialized_model:
+                    models.append((id, serialized_model))
+            publish_models(redis_client, self.namespace, models)
+            training_leases.trained([id for id, serialized_model in models])
+            # Failures are not retried, the sweep queues them again while they have no model
+            training_queue.done([id for id, count in claimed])
+        finally:
+            for id, count in claimed:
+                training_leases.release(id)
+        return spent
+
+    def train_aggregate(self, http_records_collection, samples_collection, sample_reservoir, id, count):
+        records = sample_reservoir.load(id)
+        if records.shape[0] < sample_reservoir.size // 2:
+            # Reservoir still filling up, e.g. right after deployment
+            records = self.sample_records(http_records_collection, id, count)
+        # The sample is kept as a single document with the raw feature values
+        samples_collection.delete_many({ "aggregate_id": id })
+        samples_collection.insert_one({ "aggregate_id": id,
+                                        "timestamp": int(time.time()),
+                                        "fields": list(FEATURE_FIELDS),
+                                        "rows": records.shape[0],
+                                        "data": records.tobytes() })
+        training_data = self.prepare_array(records)
+        logger.info("Training aggregated path '%s' with %d samples", id, training_data.shape[0])
+        model = self.fit_model(training_data)
+        model.feature_means = training_data.mean(axis=0)
+        model.feature_stds = training_data.std(axis=0)
+        return model.encode()
+
+    def fit_model(self, training_data):
+        if anomaly_model == 'approximate':
+            return self.fit_approximate_model(training_data)
+        return self.fit_exact_model(training_data)
+
+    def fit_exact_model(self, training_data):
+        from sklearn import svm # Only trainers load sklearn
+        model = svm.OneClassSVM(nu=0.001, kernel="rbf", gamma='scale')
+        model.fit(training_data)
+        return OneClassModel.from_svm(model)
+
+    #
+    # Maps the samples on a Nystroem approximation of the same RBF kernel and
+    # fits a linear one-class boundary there, so scoring costs the same for
+    # every aggregate whatever the number of support vectors the exact model
+    # would need.
+    #
+    def fit_approximate_model(self, training_data):
+        from sklearn import svm
+        from sklearn.kernel_approximation import Nystroem
+        gamma = 1 / (training_data.shape[1] * training_data.var()) # Same as gamma='scale'
+        feature_map = Nystroem(kernel="rbf", gamma=gamma, n_components=min(anomaly_kernel_components, training_data.shape[0]))
+        feature_map.fit(training_data)
+        model = ApproximateOneClassModel(feature_map.components_, feature_map.normalization_.T, None, 0.0, gamma)
+        svm_model = svm.OneClassSVM(nu=0.001, kernel="linear")
+        svm_model.fit(model.transform(training_data))
+        model.weights = svm_model.coef_[0]
+        model.intercept = float(svm_model.intercept_[0])
+        return model
+
+    def is_anomalous(self, model_cache, training_triggers, data):
         aggregate_id = data.get('aggregate_id')
         if aggregate_id:
-            serialized_model = redis_client.get(self.namespace + '/' + aggregate_id)
-            if serialized_model:
-                model = pickle.loads(serialized_model)
-                data_to_evaluate = np.matrix(self.prepare_data(data))
+            model = model_cache.get(aggregate_id)
+            if model is not None:
+                data_to_evaluate = np.array([self.prepare_data(data)])
                 result = model.predict(data_to_evaluate)
+                training_triggers.observe(aggregate_id, model_cache.version(aggregate_id), model, data_to_evaluate, int(result[0] == -1))
                 if result[0] == -1:
                     return True
+            else:
+                training_triggers.missing_model(aggregate_id, 1)
         return False
 
+    def evaluate_batch(self, model_cache, training_triggers, records):
+        results = [False] * len(records)
+        for aggregate_id, positions in self.group_by_aggregate(records).items():
+            model = model_cache.get(aggregate_id)
+            if model is not None:
+                data_to_evaluate = self.prepare_batch([records[position] for position in positions])
+                predictions = model.predict(data_to_evaluate)
+                training_triggers.observe(aggregate_id, model_cache.version(aggregate_id), model, data_to_evaluate, np.count_nonzero(predictions == -1))
+                for position, prediction in zip(positions, predictions):
+                    results[position] = prediction == -1
+            else:
+                training_triggers.missing_model(aggregate_id, len(positions))
+        return results
+
+    def group_by_aggregate(self, records):
+        groups = {}
+        for position, data in enumerate(records):
+            aggregate_id = data.get('aggregate_id')
+            if aggregate_id:
+                groups.setdefault(aggregate_id, []).append(position)
+        return groups
+
+    def deserialize_model(self, serialized_model):
+        if is_encoded_model(serialized_model):
+            kind, arrays, attributes = decode_model(serialized_model)
+            return MODEL_KINDS[kind].from_arrays(arrays, attributes)
+        return pickle.loads(serialized_model) # Stored before the compact format, until retrained
+
     def prepare_data(self, data):
         kbytes_sent = float(data.get("bytes_sent", 0))         / 1024
         kbytes_received = float(data.get("bytes_received", 0)) / 1024
@@ -101,3 +201,137 @@ class AnomalyDetector:
             duration
         ]
         return processed_data
+
+    def sample_records(self, http_records_collection, id, count):
+        sample_percentage = 1000 / count
+        chunk_range = int(sample_percentage * 65535)
+        chunk_start = random.randint(0, int((1 - sample_percentage) * 65535))
+        chunk_end = chunk_start + chunk_range
+        return self.load_records(http_records_collection,
+                                 { "aggregate_id": id, "random": { "$gte": chunk_start, "$lte": chunk_end } },
+                                 1000)
+
+    def load_records(self, http_records_collection, query, expected):
+        # Only the feature fields are fetched, straight into a preallocated array
+        records = np.empty((int(expected * 1.25) + 16, len(FEATURE_FIELDS)))
+        size = 0
+        projection = { field: 1 for field in FEATURE_FIELDS }
+        projection['_id'] = 0
+        for http_record in http_records_collection.find(query, projection, batch_size=TRAINING_CURSOR_BATCH_SIZE):
+            if size == records.shape[0]:
+                records = np.concatenate((records, np.empty_like(records)))
+            records[size] = [http_record.get(field, 0) for field in FEATURE_FIELDS]
+            size += 1
+        return records[:size]
+
+    def prepare_batch(self, records):
+        return self.prepare_array(np.array([[data.get(field, 0) for field in FEATURE_FIELDS] for data in records], dtype=float))
+
+    def prepare_array(self, processed_data):
+        processed_data = processed_data / [1024, 1024, 100, 1]
+        without_fraction = processed_data[:, 3] % 1 == 0 # Adding some noise as microseconds if not present
+        processed_data[without_fraction, 3] += np.random.randint(-499, 500, np.count_nonzero(without_fraction)) / 1000
+        return processed_data
+
+
+#
+# Mean and standard deviation of the training features, stored along with
+# the model so the scorers can tell when the traffic drifts away from them.
+#
+def feature_statistics(model):
+    if model.feature_means is None:
+        return {}
+    return { 'feature_means': model.feature_means, 'feature_stds': model.feature_stds }
+
+
+def with_feature_statistics(model, arrays):
+    model.feature_means = arrays.get('feature_means')
+    model.feature_stds = arrays.get('feature_stds')
+    return model
+
+
+def rbf_kernel(features, vectors, vectors_norms, gamma):
+    distances = (features ** 2).sum(axis=1)[:, None] + vectors_norms - 2 * features @ vectors.T
+    return np.exp(-gamma * np.maximum(distances, 0))
+
+
+#
+# RBF one-class SVM evaluated with numpy from the fitted support vectors, so
+# scoring needs neither sklearn nor pickle. Matches OneClassSVM.predict.
+#
+class OneClassModel:
+
+    kind = 'one-class-svm-rbf'
+
+    def __init__(self, support_vectors, dual_coefficients, intercept, gamma):
+        self.support_vectors = support_vectors
+        self.dual_coefficients = dual_coefficients
+        self.intercept = intercept
+        self.gamma = gamma
+        self.support_vectors_norms = (support_vectors ** 2).sum(axis=1)
+        self.feature_means = None
+        self.feature_stds = None
+
+    @classmethod
+    def from_svm(cls, model):
+        return cls(np.asarray(model.support_vectors_), model.dual_coef_[0], float(model.intercept_[0]), float(model._gamma))
+
+    @classmethod
+    def from_arrays(cls, arrays, attributes):
+        return with_feature_statistics(cls(arrays['support_vectors'], arrays['dual_coefficients'], attributes['intercept'], attributes['gamma']), arrays)
+
+    def encode(self):
+        return encode_model(self.kind,
+                            { 'support_vectors': self.support_vectors, 'dual_coefficients': self.dual_coefficients, **feature_statistics(self) },
+                            intercept=self.intercept,
+                            gamma=self.gamma)
+
+    def decision_function(self, features):
+        return rbf_kernel(features, self.support_vectors, self.support_vectors_norms, self.gamma) @ self.dual_coefficients + self.intercept
+
+    def predict(self, features):
+        return np.where(self.decision_function(features) > 0, 1, -1)
+
+
+#
+# Linear one-class boundary over a Nystroem map of the RBF kernel, with a
+# fixed number of landmarks. Mapped vectors are scaled back to unit norm,
+# as in the exact kernel space, otherwise records far from every landmark
+# collapse near the origin and distort the boundary.
+#
+class ApproximateOneClassModel:
+
+    kind = 'one-class-nystroem'
+
+    def __init__(self, landmarks, projection, weights, intercept, gamma):
+        self.landmarks = landmarks
+        self.projection = projection
+        self.weights = weights
+        self.intercept = intercept
+        self.gamma = gamma
+        self.landmarks_norms = (landmarks ** 2).sum(axis=1)
+        self.feature_means = None
+        self.feature_stds = None
+
+    @classmethod
+    def from_arrays(cls, arrays, attributes):
+        return with_feature_statistics(cls(arrays['landmarks'], arrays['projection'], arrays['weights'], attributes['intercept'], attributes['gamma']), arrays)
+
+    def encode(self):
+        return encode_model(self.kind,
+                            { 'landmarks': self.landmarks, 'projection': self.projection, 'weights': self.weights, **feature_statistics(self) },
+                            intercept=self.intercept,
+                            gamma=self.gamma)
+
+    def transform(self, features):
+        mapped = rbf_kernel(features, self.landmarks, self.landmarks_norms, self.gamma) @ self.projection
+        return mapped / np.maximum(np.linalg.norm(mapped, axis=1, keepdims=True), 1e-12)
+
+    def decision_function(self, features):
+        return self.transform(features) @ self.weights + self.intercept
+
+    def predict(self, features):
+        return np.where(self.decision_function(features) > 0, 1, -1)
+
+
+MODEL_KINDS = { model_class.kind: model_class for model_class in (OneClassModel, ApproximateOneClassModel) }
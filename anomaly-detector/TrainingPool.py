@@ -0,0 +1,112 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import multiprocessing
+import random
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pymongo import MongoClient
+
+logger = logging.getLogger()
+
+worker = {}
+
+
+def init_worker(detector, mongo_url, mongo_database, mongo_http_records, mongo_samples, sample_reservoir):
+    # Every worker process opens its own Mongo connections, the client is not fork safe.
+    # The Redis client of the reservoir reopens its pooled connections by itself.
+    random.seed()
+    np.random.seed()
+    client = MongoClient(mongo_url)
+    database = client[mongo_database]
+    worker['detector'] = detector
+    worker['http_records_collection'] = database[mongo_http_records]
+    worker['samples_collection'] = database[mongo_samples]
+    worker['sample_reservoir'] = sample_reservoir
+
+
+def train(item):
+    aggregate_id, count = item
+    started = time.process_time()
+    try:
+        serialized_model = worker['detector'].train_aggregate(worker['http_records_collection'],
+                                                              worker['samples_collection'],
+                                                              worker['sample_reservoir'],
+                                                              aggregate_id,
+                                                              count)
+        return aggregate_id, serialized_model, time.process_time() - started
+    except:
+        logger.exception("Failure training aggregated path '%s'.", aggregate_id)
+        return aggregate_id, None, time.process_time() - started
+
+
+#
+# Runs sampling, feature extraction and fitting in worker processes, so a
+# training sweep does not compete for the GIL with the scoring thread. Only
+# the serialized models and the CPU time spent on them come back to the
+# parent.
+#
+# The workers are forked when the pool is created, so it must be created
+# before any thread is started. If a worker dies, e.g. killed for running out
+# of memory, the aggregates still in flight are reported as failed and the
+# workers are forked again, this time from the running service.
+# With no workers, training runs in the calling thread.
+#
+class TrainingPool:
+
+    def __init__(self, workers, detector, mongo_url, mongo_database, mongo_http_records, mongo_samples, sample_reservoir):
+        self.workers = workers
+        self.initargs = (detector, mongo_url, mongo_database, mongo_http_records, mongo_samples, sample_reservoir)
+        if workers > 0:
+            self.executor = self.start_executor()
+        else:
+            self.executor = None
+            init_worker(*self.initargs)
+
+    def start_executor(self):
+        executor = ProcessPoolExecutor(self.workers,
+                                       mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_worker,
+                                       initargs=self.initargs)
+        # Workers are only forked on the first submission
+        executor.submit(int).result()
+        return executor
+
+    def train(self, items):
+        if self.executor:
+            return self.train_in_workers(items)
+        return map(train, items)
+
+    def train_in_workers(self, items):
+        futures = { self.executor.submit(train, item): item for item in items }
+        broken = False
+        for future in as_completed(futures):
+            aggregate_id, count = futures[future]
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                broken = True
+                yield aggregate_id, None, 0
+        if broken:
+            logger.error('Training worker died, restarting %d training workers.', self.workers)
+            self.executor.shutdown(wait=False)
+            self.executor = self.start_executor()
+
+    def size(self):
+        return max(self.workers, 1)
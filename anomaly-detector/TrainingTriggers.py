@@ -0,0 +1,91 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+#
+# Scorer side of the training queue. Batches evaluated by the scorer are
+# summarized per aggregate and, on every flush, an aggregate is queued when:
+#
+#  - it has no model and its sample reservoir is full;
+#  - more than 'anomaly_rate' of its records were anomalous;
+#  - the mean of some feature moved more than 'drift' training standard
+#    deviations away from the training mean.
+#
+# Statistics are taken over windows of at least 'min_records' records and
+# start over when the generation stamp of the model changes. Windows keep
+# only the training statistics, not the model, and at most 'max_windows'
+# of them are kept, dropping the least recently observed.
+#
+class TrainingTriggers:
+
+    def __init__(self, training_queue, sample_reservoir, anomaly_rate=0.01, drift=0.5, min_records=200, max_windows=10000):
+        self.training_queue = training_queue
+        self.sample_reservoir = sample_reservoir
+        self.anomaly_rate = anomaly_rate
+        self.drift = drift
+        self.min_records = min_records
+        self.max_windows = max_windows
+        self.unmodelled = {}
+        self.windows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def missing_model(self, aggregate_id, records):
+        with self.lock:
+            self.unmodelled[aggregate_id] = self.unmodelled.get(aggregate_id, 0) + records
+
+    def observe(self, aggregate_id, version, model, features, anomalies):
+        with self.lock:
+            window = self.windows.get(aggregate_id)
+            if window is None or window[0] != version:
+                window = self.windows[aggregate_id] = [version, getattr(model, 'feature_means', None),
+                                                       getattr(model, 'feature_stds', None), 0, 0, 0]
+            self.windows.move_to_end(aggregate_id)
+            while len(self.windows) > self.max_windows:
+                self.windows.popitem(last=False)
+            window[3] += features.shape[0]
+            window[4] += anomalies
+            window[5] = window[5] + features.sum(axis=0)
+
+    def flush(self):
+        with self.lock:
+            unmodelled = self.unmodelled
+            self.unmodelled = {}
+            windows = { aggregate_id: window for aggregate_id, window in self.windows.items() if window[3] >= self.min_records }
+            for aggregate_id in windows:
+                del self.windows[aggregate_id]
+        requests = {}
+        for aggregate_id, records in unmodelled.items():
+            if self.sample_reservoir.is_full(aggregate_id):
+                requests[aggregate_id] = records
+        for aggregate_id, (version, training_means, training_stds, records, anomalies, sums) in windows.items():
+            if anomalies > self.anomaly_rate * records or self.drifted(training_means, training_stds, sums / records):
+                requests[aggregate_id] = records
+        if requests:
+            self.training_queue.request(requests)
+            logger.info('Requested training of %d aggregates.', len(requests))
+
+    def drifted(self, training_means, training_stds, means):
+        if training_means is None:
+            return False # Trained before the statistics were kept
+        # Features constant in training, as the status often is, only drift relative to their value
+        shift = np.abs(means - training_means) / np.maximum(training_stds, 0.1 * np.abs(training_means) + 1e-6)
+        return shift.max() > self.drift
@@ -0,0 +1,91 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Agreement between the exact and the approximate anomaly models over stored
+# traffic, e.g. after a run of log-replay.
+#
+# For the busiest aggregates, both models are fitted on the same sample and
+# score the most recent records of the aggregate.
+#
+# Usage: python report-approximate-agreement.py [aggregates] [records]
+#
+
+import os
+import sys
+import time
+import logging
+import numpy as np
+from pymongo import MongoClient
+from AnomalyDetector import AnomalyDetector
+
+logging.disable(logging.INFO)
+
+if 'MONGO_URL' in os.environ:
+    mongo_url = os.environ['MONGO_URL']
+else:
+    mongo_url = 'mongodb://localhost:27017/'
+if 'MONGO_DATABASE' in os.environ:
+    mongo_database = os.environ['MONGO_DATABASE']
+else:
+    mongo_database = 'kubeowl'
+if 'MONGO_HTTP_RECORDS' in os.environ:
+    mongo_http_records = os.environ['MONGO_HTTP_RECORDS']
+else:
+    mongo_http_records = 'http_records'
+if 'MONGO_AGGREGATES' in os.environ:
+    mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+    mongo_aggregates = 'aggregates'
+
+
+def score(model, data):
+    started = time.perf_counter()
+    predictions = model.predict(data)
+    return predictions == -1, (time.perf_counter() - started) / len(data)
+
+
+if __name__ == "__main__":
+    aggregates = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    database = MongoClient(mongo_url)[mongo_database]
+    http_records_collection = database[mongo_http_records]
+    detector = AnomalyDetector()
+    print('%-36s %8s %6s %6s %9s %9s %9s %9s' % ('aggregate_id', 'records', 'svs', 'lmarks', 'agreement', 'exact', 'approx', 'us/rec'))
+    total = 0
+    agreeing = 0
+    for aggregate in database[mongo_aggregates].find({ "count": { "$gt": 1000 } }).sort("count", -1).limit(aggregates):
+        aggregate_id = aggregate.get('_id')
+        sample = list(http_records_collection.aggregate([{ "$match": { "aggregate_id": aggregate_id } },
+                                                          { "$sample": { "size": 1000 } }]))
+        traffic = list(http_records_collection.find({ "aggregate_id": aggregate_id }).sort("timestamp", -1).limit(records))
+        if not sample or not traffic:
+            continue
+        training_data = np.array([detector.prepare_data(data) for data in sample])
+        exact_model = detector.fit_exact_model(training_data)
+        approximate_model = detector.fit_approximate_model(training_data)
+        data = detector.prepare_batch(traffic)
+        exact, exact_time = score(exact_model, data)
+        approximate, approximate_time = score(approximate_model, data)
+        matches = np.count_nonzero(exact == approximate)
+        total += len(data)
+        agreeing += matches
+        print('%-36s %8d %6d %6d %8.2f%% %8.2f%% %8.2f%% %4.1f/%4.1f' % (
+            aggregate_id, len(data), len(exact_model.support_vectors), len(approximate_model.landmarks),
+            100 * matches / len(data), 100 * exact.mean(), 100 * approximate.mean(),
+            exact_time * 1e6, approximate_time * 1e6))
+    if total:
+        print('Overall agreement: %.2f%% over %d records.' % (100 * agreeing / total, total))
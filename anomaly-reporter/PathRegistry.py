@@ -0,0 +1,62 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+from collections import OrderedDict
+
+#
+# Bounded LRU cache of aggregated paths, keyed by aggregate_id.
+#
+# Paths missing from the cache are read with a single $in query on the
+# aggregates collection maintained by enrichment, for all the aggregates
+# of a report at once. The streaming reporter also adds the paths seen on
+# the records.
+#
+class PathRegistry:
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.paths = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, aggregate_id, aggregated_http_path):
+        with self.lock:
+            self.paths[aggregate_id] = aggregated_http_path
+            self.paths.move_to_end(aggregate_id)
+            while len(self.paths) > self.max_size:
+                self.paths.popitem(last=False)
+
+    def resolve(self, aggregates_collection, aggregate_ids):
+        paths = {}
+        missing = []
+        with self.lock:
+            for aggregate_id in aggregate_ids:
+                aggregated_http_path = self.paths.get(aggregate_id)
+                if aggregated_http_path:
+                    self.paths.move_to_end(aggregate_id)
+                    paths[aggregate_id] = aggregated_http_path
+                else:
+                    missing.append(aggregate_id)
+        if missing:
+            for aggregate in aggregates_collection.find({ "_id": { "$in": missing } }, { "aggregated_http_path": 1 }):
+                aggregated_http_path = aggregate.get("aggregated_http_path")
+                if aggregated_http_path:
+                    paths[aggregate.get("_id")] = aggregated_http_path
+                    self.put(aggregate.get("_id"), aggregated_http_path)
+        return paths
+
+    def size(self):
+        return len(self.paths)
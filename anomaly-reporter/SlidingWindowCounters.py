@@ -0,0 +1,66 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+
+#
+# Event counts per key over the last 'window' seconds, in a ring of buckets
+# of 'bucket_seconds' each. Every slot keeps the bucket it counts, so slots
+# left over from a previous turn of the ring are simply ignored, and events
+# older than the ring are dropped.
+#
+class SlidingWindowCounters:
+
+    def __init__(self, window=300, bucket_seconds=10):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = -(-window // bucket_seconds)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, timestamp, count=1):
+        bucket = int(timestamp // self.bucket_seconds)
+        slot = bucket % self.buckets
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = ([0] * self.buckets, [-1] * self.buckets)
+            counts, stamps = entry
+            if stamps[slot] != bucket:
+                if stamps[slot] > bucket:
+                    return
+                counts[slot] = 0
+                stamps[slot] = bucket
+            counts[slot] += count
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def totals(self, now, window_sizes):
+        # Sums of the last seconds of each window, up to the bucket of 'now', in a single pass
+        last = int(now // self.bucket_seconds)
+        firsts = [last - min(-(-window_size // self.bucket_seconds), self.buckets) + 1 for window_size in window_sizes]
+        totals = [{} for window_size in window_sizes]
+        with self.lock:
+            for key, (counts, stamps) in list(self.entries.items()):
+                if max(stamps) <= last - self.buckets:
+                    del self.entries[key]
+                    continue
+                for first, window_totals in zip(firsts, totals):
+                    total = sum(count for count, stamp in zip(counts, stamps) if first <= stamp <= last)
+                    if total:
+                        window_totals[key] = total
+        return totals
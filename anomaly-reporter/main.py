@@ -19,8 +19,11 @@ import sys
 import logging
 import time
 import threading
+import json
+import pika
 from pymongo import MongoClient
-from bson.son import SON
+from SlidingWindowCounters import SlidingWindowCounters
+from PathRegistry import PathRegistry
 from flask import Flask
 from prometheus_flask_exporter import PrometheusMetrics
 from prometheus_client import Gauge
@@ -34,6 +37,15 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s -
 logger.addHandler(handler)
 
 
+if 'REPORTER_MODE' in os.environ:
+    reporter_mode = os.environ['REPORTER_MODE']
+else:
+    reporter_mode = 'polling'
+if reporter_mode not in ('polling', 'streaming'):
+    logger.fatal('Invalid REPORTER_MODE: %s (expected polling or streaming).', reporter_mode)
+    sys.exit()
+logger.info('Reporter mode: %s', reporter_mode)
+
 if 'MONGO_URL' in os.environ:
     mongo_url = os.environ['MONGO_URL']
     logger.info('Using mongo URL: %s', mongo_url)
@@ -59,16 +71,89 @@ else:
     mongo_anomalies = "anomalies"
 logger.info('Anomalies collection is: %s', mongo_anomalies)
 
+if 'MONGO_AGGREGATES' in os.environ:
+    mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+    mongo_aggregates = 'aggregates'
+logger.info('Aggregates collection is: %s', mongo_aggregates)
+
+if 'ANOMALY_SERIES_IDLE_SECONDS' in os.environ:
+    anomaly_series_idle_seconds = int(os.environ['ANOMALY_SERIES_IDLE_SECONDS'])
+else:
+    anomaly_series_idle_seconds = 3600
+logger.info('Anomaly series removed after: %d idle seconds', anomaly_series_idle_seconds)
+
+if 'PATH_REGISTRY_SIZE' in os.environ:
+    path_registry_size = int(os.environ['PATH_REGISTRY_SIZE'])
+else:
+    path_registry_size = 10000
+logger.info('Aggregated paths cache size: %d', path_registry_size)
+
+if 'MONGO_ROLLUPS' in os.environ:
+    mongo_rollups = os.environ['MONGO_ROLLUPS']
+else:
+    mongo_rollups = 'rollups'
+logger.info('Rollups collection is: %s', mongo_rollups)
+
+if 'ROLLUPS_RETENTION' in os.environ:
+    rollups_retention = int(os.environ['ROLLUPS_RETENTION'])
+else:
+    rollups_retention = 86400
+logger.info('Rollups retention: %d seconds', rollups_retention)
+
+if 'ROLLUPS_FLUSH_DELAY' in os.environ:
+    rollups_flush_delay = int(os.environ['ROLLUPS_FLUSH_DELAY'])
+else:
+    rollups_flush_delay = 15
+logger.info('Rollups flush delay: %d seconds', rollups_flush_delay)
+
+if reporter_mode == 'streaming':
+    if 'RABBITMQ_HOST' in os.environ:
+        rabbitmq_host = os.environ['RABBITMQ_HOST']
+        logger.info('Using RabbitMQ host: %s', rabbitmq_host)
+    else:
+        logger.fatal('Missing RABBITMQ_HOST environment variable.')
+        sys.exit()
+
+if 'RABBITMQ_EXCHANGE' in os.environ:
+    rabbitmq_exchange = os.environ['RABBITMQ_EXCHANGE']
+else:
+    rabbitmq_exchange = "http_enriched_records"
+logger.info('RabbitMQ exchange: %s', rabbitmq_exchange)
+
+if 'RABBITMQ_ANOMALIES_EXCHANGE' in os.environ:
+    rabbitmq_anomalies_exchange = os.environ['RABBITMQ_ANOMALIES_EXCHANGE']
+else:
+    rabbitmq_anomalies_exchange = "anomalies"
+logger.info('RabbitMQ anomalies exchange: %s', rabbitmq_anomalies_exchange)
+
+if 'REPORTER_INTERVAL' in os.environ:
+    reporter_interval = int(os.environ['REPORTER_INTERVAL'])
+else:
+    reporter_interval = 5
+logger.info('Streaming report interval: %d seconds', reporter_interval)
+
+if 'REPORTER_BUCKET_SECONDS' in os.environ:
+    reporter_bucket_seconds = int(os.environ['REPORTER_BUCKET_SECONDS'])
+else:
+    reporter_bucket_seconds = 10
+logger.info('Streaming window bucket size: %d seconds', reporter_bucket_seconds)
+
 
 service_ok = False
 records_processed = 0
 flask_app = Flask(__name__)
 metrics = PrometheusMetrics(flask_app)
-aggregated_http_path_dict = {}
+path_registry = PathRegistry(path_registry_size)
 anomaly_gauge = Gauge('kubeowl_anomalies',
                       'Percentage of anomalies for a given endpoint.',
                       ['aggregate_id', 'aggregated_http_path', 'anomaly'])
 metrics_dict = {}
+Gauge('kubeowl_anomalies_series', 'Number of series currently exported by kubeowl_anomalies.').set_function(lambda: len(metrics_dict))
+window_sizes = [180, 240, 300]
+records_counters = SlidingWindowCounters(max(window_sizes), reporter_bucket_seconds)
+anomalies_counters = SlidingWindowCounters(max(window_sizes), reporter_bucket_seconds)
+stream_cutoff = 0
 
 
 @flask_app.route('/healthcheck')
@@ -90,26 +175,69 @@ anomalies_collection = database[mongo_anomalies]
 anomalies_collection.create_index([("aggregate_id", 1)])
 anomalies_collection.create_index([("timestamp", 1)])
 anomalies_collection.create_index([("aggregate_id", 1), ("timestamp", 1)])
+rollups_collection = database[mongo_rollups]
+rollups_collection.create_index([("minute", 1)])
+rollups_collection.create_index([("created_at", 1)], expireAfterSeconds=rollups_retention)
 
 
-def get_aggregated_http_path(id, collection):
-    result = aggregated_http_path_dict.get(id)
-    if not result:
-        a_record = collection.find_one({ "aggregate_id": id })
-        result = a_record.get("aggregated_http_path")
-        aggregated_http_path_dict[id] = result
-    return result
+#
+# Records and anomalies of each aggregate over the last seconds of complete
+# minutes before 'now', for each of 'window_sizes', summed from the per
+# minute rollups written by enrichment and the detectors. The rollups of the
+# largest window are read once and every window is derived from them.
+# Anomalies come ordered by count.
+#
+def sum_rollups(rollups_collection, now, window_sizes):
+    # Minutes still being flushed by enrichment and the detectors are left out
+    window_end = int(now - rollups_flush_delay) // 60 * 60
+    windows = [({}, {}) for window_size in window_sizes]
+    query = { "minute": { "$gte": window_end - max(window_sizes), "$lt": window_end } }
+    for rollup in rollups_collection.find(query, { "aggregate_id": 1, "minute": 1, "records": 1, "anomalies": 1 }):
+        aggregate_id = rollup.get("aggregate_id")
+        minute = rollup.get("minute")
+        for window_size, (records, anomalies) in zip(window_sizes, windows):
+            if minute >= window_end - window_size:
+                records[aggregate_id] = records.get(aggregate_id, 0) + rollup.get("records", 0)
+                for anomaly, count in rollup.get("anomalies", {}).items():
+                    anomalies[(aggregate_id, anomaly)] = anomalies.get((aggregate_id, anomaly), 0) + count
+    return [(records, sort_by_count(anomalies)) for records, anomalies in windows]
 
-def report_anomaly_rate(anomalies_to_report):
 
-    current_keys = []
-    for key, value in anomalies_to_report.items():
-        anomaly = value.get('anomaly')
-        current_keys.append(key + '/' + anomaly)
-    # Set to zero metrics that were not sent to update
-    for key, value in metrics_dict.items():
-        if not key in current_keys:
-            value.set(0)
+def sort_by_count(anomalies):
+    return sorted(anomalies.items(), key=lambda item: (item[1], item[0]), reverse=True)
+
+
+def select_anomalies(windows, aggregates_collection):
+    anomalies_to_report = {}
+    for records, anomalies in windows:
+        for (aggregate_id, anomaly), count in anomalies:
+            # Records are counted by enrichment, they may still be missing if it lagged behind
+            if count > 5 and records.get(aggregate_id) and not anomalies_to_report.get(aggregate_id):
+                rate = count / records.get(aggregate_id)
+                anomalies_to_report[aggregate_id] = {
+                    'anomaly': anomaly,
+                    'rate': rate
+                }
+    paths = path_registry.resolve(aggregates_collection, list(anomalies_to_report))
+    for aggregate_id, value in anomalies_to_report.items():
+        value['path'] = paths.get(aggregate_id, 'unknown')
+    return anomalies_to_report
+
+
+#
+# Series of endpoints no longer anomalous are set to zero, and removed from
+# the gauge once they have not been reported for 'anomaly_series_idle_seconds'.
+#
+def report_anomaly_rate(anomalies_to_report):
+    now = time.monotonic()
+    current_keys = { key + '/' + value.get('anomaly') for key, value in anomalies_to_report.items() }
+    for dict_key in metrics_dict.keys() - current_keys:
+        metric, labels, last_reported = metrics_dict.get(dict_key)
+        if now - last_reported > anomaly_series_idle_seconds:
+            anomaly_gauge.remove(*labels)
+            del metrics_dict[dict_key]
+        else:
+            metric.set(0)
 
     # Update anomalies values
     for key, value in anomalies_to_report.items():
@@ -119,50 +247,32 @@ def report_anomaly_rate(anomalies_to_report):
         rate = value.get('rate')
         percentage = round(rate * 100, 2)
         logger.info('Anomaly detected for aggregate_id=%s (type %s, aggregated_http_path %s) with %.2f%%', key, anomaly, path, percentage)
-        metric = metrics_dict.get(dict_key)
-        if not metric:
-            metric = anomaly_gauge.labels(aggregate_id=key, aggregated_http_path=path, anomaly=anomaly)
-            metrics_dict[dict_key] = metric
+        labels = (key, path, anomaly)
+        entry = metrics_dict.get(dict_key)
+        if entry and entry[1] != labels:
+            # The path was not known when the series was created
+            anomaly_gauge.remove(*entry[1])
+            entry = None
+        metric = entry[0] if entry else anomaly_gauge.labels(*labels)
         metric.set(percentage)
+        metrics_dict[dict_key] = (metric, labels, now)
 
 
 def run_reporter():
     global service_ok
     while True:
-        next_execution_timestamp = int(time.time()) - (int(time.time()) % 60)
+        # Evaluated right after the rollups of the last minute are flushed
+        next_execution_timestamp = int(time.time() - rollups_flush_delay) // 60 * 60 + rollups_flush_delay
         try:
-            window_sizes = [180, 240, 300]
             client = MongoClient(mongo_url)
             database = client[mongo_database]
-            anomalies_collection = database[mongo_anomalies]
-            http_records_collection = database[mongo_http_records]
+            aggregates_collection = database[mongo_aggregates]
+            rollups_collection = database[mongo_rollups]
             service_ok = True
             while True:
                 logger.info('Starting evaluating anomalies.')
-                anomalies_to_report = {}
-                for window_size in window_sizes:
-                    now = time.time()
-                    pipeline = [
-                        { "$match": { "timestamp": { "$gte": now - window_size, "$lt": now } } },
-                        { "$group": {"_id": { "aggregate_id": "$aggregate_id", "anomaly": "$anomaly" }, "count": {"$sum": 1} } },
-                        { "$sort": SON([ ("count", -1), ("_id", -1) ]) }
-                    ]
-                    anomalies_aggregates = list(anomalies_collection.aggregate(pipeline))
-                    http_requests_aggregates = list(http_records_collection.aggregate(pipeline))
-                    http_requests_aggregates_dict = {}
-                    for http_requests_aggregate in http_requests_aggregates:
-                        http_requests_aggregates_dict[http_requests_aggregate.get("_id").get("aggregate_id")] = http_requests_aggregate.get("count")
-                    for anomalies_aggregate in anomalies_aggregates:
-                        aggregate_id = anomalies_aggregate.get("_id").get("aggregate_id")
-                        anomaly = anomalies_aggregate.get("_id").get("anomaly", "unknown")
-                        count = anomalies_aggregate.get("count")
-                        if count > 5 and not anomalies_to_report.get(aggregate_id):
-                            rate = count / http_requests_aggregates_dict.get(aggregate_id)
-                            anomalies_to_report[aggregate_id] = {
-                                'path': get_aggregated_http_path(aggregate_id, anomalies_collection),
-                                'anomaly': anomaly,
-                                'rate': rate
-                            }
+                windows = sum_rollups(rollups_collection, time.time(), window_sizes)
+                anomalies_to_report = select_anomalies(windows, aggregates_collection)
                 logger.info('Done evaluating anomalies.')
                 report_anomaly_rate(anomalies_to_report)
                 next_execution_timestamp += 60
@@ -175,9 +285,102 @@ def run_reporter():
             time.sleep(15)
 
 
+#
+# Streaming mode: records and anomaly events are counted in memory as they
+# are published, and the report is refreshed every 'reporter_interval'
+# seconds without reading the database. Events are only counted from the
+# moment the queues are bound, the window before that is read once from the
+# raw collections.
+#
+def count_record(channel, method, properties, body):
+    data = json.loads(body)
+    aggregate_id = data.get('aggregate_id')
+    timestamp = data.get('timestamp', 0)
+    if aggregate_id and timestamp >= stream_cutoff:
+        records_counters.add(aggregate_id, timestamp)
+        if data.get('aggregated_http_path'):
+            path_registry.put(aggregate_id, data.get('aggregated_http_path'))
+
+
+def count_anomaly(channel, method, properties, body):
+    data = json.loads(body)
+    aggregate_id = data.get('aggregate_id')
+    timestamp = data.get('timestamp', 0)
+    if aggregate_id and timestamp >= stream_cutoff:
+        anomalies_counters.add((aggregate_id, data.get('anomaly', 'unknown')), timestamp)
+
+
+def backfill_counters(http_records_collection, anomalies_collection, cutoff):
+    bucket = { "$subtract": [ "$timestamp", { "$mod": [ "$timestamp", reporter_bucket_seconds ] } ] }
+    match = { "$match": { "timestamp": { "$gte": cutoff - max(window_sizes), "$lt": cutoff } } }
+    pipeline = [ match, { "$group": { "_id": { "aggregate_id": "$aggregate_id", "bucket": bucket }, "count": { "$sum": 1 } } } ]
+    for group in http_records_collection.aggregate(pipeline):
+        records_counters.add(group.get("_id").get("aggregate_id"), group.get("_id").get("bucket"), group.get("count"))
+    pipeline = [ match, { "$group": { "_id": { "aggregate_id": "$aggregate_id", "anomaly": "$anomaly", "bucket": bucket }, "count": { "$sum": 1 } } } ]
+    for group in anomalies_collection.aggregate(pipeline):
+        key = (group.get("_id").get("aggregate_id"), group.get("_id").get("anomaly", "unknown"))
+        anomalies_counters.add(key, group.get("_id").get("bucket"), group.get("count"))
+
+
+def bind_exclusive_queue(channel, exchange):
+    channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+    queue = channel.queue_declare(queue='', exclusive=True).method.queue
+    channel.queue_bind(exchange=exchange, queue=queue)
+    return queue
+
+
+def run_stream_consumer():
+    global service_ok, stream_cutoff
+    while True:
+        try:
+            client = MongoClient(mongo_url)
+            database = client[mongo_database]
+            connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host))
+            channel = connection.channel()
+            records_queue = bind_exclusive_queue(channel, rabbitmq_exchange)
+            anomalies_queue = bind_exclusive_queue(channel, rabbitmq_anomalies_exchange)
+            # Counters start over on every connection, events missed while disconnected come from the backfill
+            records_counters.clear()
+            anomalies_counters.clear()
+            stream_cutoff = time.time()
+            backfill_counters(database[mongo_http_records], database[mongo_anomalies], stream_cutoff)
+            client.close()
+            logger.info('Window backfilled from the database, consuming records and anomalies.')
+            channel.basic_consume(queue=records_queue, on_message_callback=count_record, auto_ack=True)
+            channel.basic_consume(queue=anomalies_queue, on_message_callback=count_anomaly, auto_ack=True)
+            service_ok = True
+            channel.start_consuming()
+        except:
+            service_ok = False
+            logger.exception("Failure consuming records and anomalies.")
+            time.sleep(15)
+
+
+def run_streaming_reporter():
+    while True:
+        try:
+            client = MongoClient(mongo_url)
+            database = client[mongo_database]
+            aggregates_collection = database[mongo_aggregates]
+            while True:
+                time.sleep(reporter_interval)
+                now = time.time()
+                windows = [(records, sort_by_count(anomalies))
+                           for records, anomalies in zip(records_counters.totals(now, window_sizes), anomalies_counters.totals(now, window_sizes))]
+                report_anomaly_rate(select_anomalies(windows, aggregates_collection))
+        except:
+            logger.exception("Failure at streaming reporter thread.")
+            time.sleep(15)
+
+
 if __name__ == "__main__":
     try:
-        training_thread = threading.Thread(target=run_reporter)
+        if reporter_mode == 'streaming':
+            stream_consumer_thread = threading.Thread(target=run_stream_consumer)
+            stream_consumer_thread.start()
+            training_thread = threading.Thread(target=run_streaming_reporter)
+        else:
+            training_thread = threading.Thread(target=run_reporter)
         training_thread.start()
         flask_app.run(host='0.0.0.0', port=80)
     except (IOError, SystemExit):
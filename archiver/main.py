@@ -19,7 +19,7 @@ import sys
 import logging
 import time
 import threading
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from flask import Flask
 from prometheus_flask_exporter import PrometheusMetrics
 
@@ -57,6 +57,12 @@ else:
     mongo_anomalies = 'anomalies'
 logger.info('HTTP anomalies collection is: %s', mongo_anomalies)
 
+if 'MONGO_AGGREGATES' in os.environ:
+    mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+    mongo_aggregates = 'aggregates'
+logger.info('Aggregates collection is: %s', mongo_aggregates)
+
 if 'ARCHIVE_RECORDS_AFTER' in os.environ:
     archive_records_after = int(os.environ['ARCHIVE_RECORDS_AFTER'])
 else:
@@ -88,7 +94,7 @@ def run_archiver():
             database = client[mongo_database]
             service_ok = True
             while True:
-                archive_records(mongo_http_records, database)
+                archive_records(mongo_http_records, database, database[mongo_aggregates])
                 archive_records(mongo_anomalies, database)
                 time.sleep(300)
         except:
@@ -98,9 +104,11 @@ def run_archiver():
             raise
 
 
-def archive_records(collection_name, database):
+def archive_records(collection_name, database, aggregates_collection=None):
     collection = database[collection_name]
     remove_older_than = int(time.time()) - archive_records_after
+    if aggregates_collection is not None:
+        discount_aggregates(collection, aggregates_collection, remove_older_than)
     result = collection.delete_many({ "timestamp": { "$lt": remove_older_than } })
     if result:
         counter.inc(result.deleted_count)
@@ -109,6 +117,19 @@ def archive_records(collection_name, database):
         logger.info("No records to remove from %s.", collection_name)
 
 
+def discount_aggregates(collection, aggregates_collection, remove_older_than):
+    # Keeps the per aggregate record counters maintained by enrichment in line with the retention
+    pipeline = [
+        { "$match": { "timestamp": { "$lt": remove_older_than } } },
+        { "$group": {"_id": "$aggregate_id", "count": {"$sum": 1} } }
+    ]
+    operations = [UpdateOne({ "_id": aggregate.get('_id') }, { "$inc": { "count": -aggregate.get('count') } })
+                  for aggregate in collection.aggregate(pipeline, allowDiskUse=True) if aggregate.get('_id')]
+    if operations:
+        aggregates_collection.bulk_write(operations, ordered=False)
+        logger.info("Updated record counters of %d aggregates.", len(operations))
+
+
 if __name__ == "__main__":
     try:
         training_thread = threading.Thread(target=run_archiver)
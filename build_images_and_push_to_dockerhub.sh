@@ -1,7 +1,7 @@
 #!/bin/bash
 
 VERSION=1.0.19
-IMAGES="enrichment,anomaly-detector,abnormal-duration-detector,anomaly-reporter,tools,archiver"
+IMAGES="enrichment,anomaly-detector,abnormal-duration-detector,abnormal-status-detector,anomaly-reporter,tools,archiver"
 
 echo ${IMAGES} | tr ',' '\n' | while read image_name; do
     docker-compose build ${image_name}
@@ -0,0 +1,68 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+from pymongo import UpdateOne
+
+logger = logging.getLogger()
+
+#
+# Number of stored records per aggregate_id, kept in the aggregates
+# collection so the detectors do not have to group the whole http_records
+# collection to find what to train.
+#
+# Counts are accumulated in memory and written with one bulk $inc per flush.
+# The archiver decrements them for the records it removes.
+#
+class AggregateCounters:
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, aggregate_id, aggregated_http_path):
+        with self.lock:
+            count = self.counts.get(aggregate_id)
+            if count:
+                count[0] += 1
+            else:
+                self.counts[aggregate_id] = [1, aggregated_http_path]
+
+    def flush(self, collection):
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        if not counts:
+            return
+        now = int(time.time())
+        operations = [UpdateOne({ "_id": aggregate_id },
+                                { "$inc": { "count": count },
+                                  "$max": { "last_seen": now },
+                                  "$setOnInsert": { "aggregated_http_path": aggregated_http_path } },
+                                upsert=True)
+                      for aggregate_id, (count, aggregated_http_path) in counts.items()]
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except:
+            # Retried on the next flush, a partially applied bulk may be counted twice
+            with self.lock:
+                for aggregate_id, (count, aggregated_http_path) in counts.items():
+                    current = self.counts.setdefault(aggregate_id, [0, aggregated_http_path])
+                    current[0] += count
+            raise
+        logger.debug('Updated record counters of %d aggregates.', len(operations))
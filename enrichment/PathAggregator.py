@@ -15,20 +15,98 @@
 #
 
 
-import re
 import logging
+import functools
+import sys
+import threading
 import uuid
+from collections import OrderedDict
 
 logger = logging.getLogger()
 
+#
+# Segment classes, in the order they are tried when compressing a node
+#
+NUMBER              = 1
+HEXADECIMAL         = 2
+UUID                = 4
+LETTERS             = 8
+LETTERS_AND_NUMBERS = 16
+ANYTHING            = 32
+
+GROUPS = [
+    { 'name': '<number>',              'class': NUMBER              },
+    { 'name': '<hexadecimal>',         'class': HEXADECIMAL         },
+    { 'name': '<uuid>',                'class': UUID                },
+    { 'name': '<letters>',             'class': LETTERS             },
+    { 'name': '<letters_and_numbers>', 'class': LETTERS_AND_NUMBERS },
+    { 'name': '<anything>',            'class': ANYTHING            },
+]
+GROUP_CLASSES = { group['name']: group['class'] for group in GROUPS }
+GROUP_ORDER = { group['name']: position for position, group in enumerate(GROUPS) }
+ALL_CLASSES = NUMBER | HEXADECIMAL | UUID | LETTERS | LETTERS_AND_NUMBERS | ANYTHING
+
+COMPRESS_THRESHOLD = 1000
+IDENTIFIER_CLASSES = NUMBER | HEXADECIMAL | UUID
+NO_CHILDREN = {}
+
+HEXADECIMAL_CHARACTERS = '0123456789abcdef'
+UUID_CHARACTERS = HEXADECIMAL_CHARACTERS + '-'
+
+
+#
+# Returns the bitmask of every segment class matched by a path segment.
+#
+# Equivalent to searching the segment with ^[0-9]+$, ^[0-9a-f]+$, the
+# lowercase uuid pattern, ^[A-Za-z]+$, ^[A-Za-z0-9]+$ and ^.+$, but decided
+# by a few str predicates instead of a regular expression search per class.
+#
+def classify_segment(segment):
+    if segment.endswith('\n'): # '$' also matches right before a trailing newline
+        segment = segment[:-1]
+    if segment.isascii():
+        if segment.isalnum():
+            if segment.isdigit():
+                return NUMBER | HEXADECIMAL | LETTERS_AND_NUMBERS | ANYTHING
+            classes = LETTERS_AND_NUMBERS | ANYTHING
+            if segment.isalpha():
+                classes |= LETTERS
+            if not segment.strip(HEXADECIMAL_CHARACTERS):
+                classes |= HEXADECIMAL
+            return classes
+        if len(segment) == 36 and segment[8] == segment[13] == segment[18] == segment[23] == '-' and \
+                segment.count('-') == 4 and not segment.strip(UUID_CHARACTERS):
+            return UUID | ANYTHING
+    if not segment or '\n' in segment:
+        return 0
+    return ANYTHING
+
+@functools.lru_cache(maxsize=65536)
+def name_uuid(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
 #
 # Data structure for path storage
 #
+# With max_nodes set, the least recently used leaves are evicted once the
+# tree grows past that many nodes. Only leaves reached by a plain segment
+# are evicted, collapsed class nodes are kept.
+#
 class PathAggregator:
 
-    def __init__(self):
-        self.root = PathNode('')
-        self.counter = 0
+    def __init__(self, max_nodes=0):
+        self.max_nodes = max_nodes
+        self.lock = threading.Lock()
+        self.changes = []
+        self.evicted_nodes = 0
+        self.reset()
+
+    def reset(self):
+        self.nodes = 0
+        self.segment_bytes = 0
+        self.leaves = OrderedDict() if self.max_nodes else None
+        self.root = PathNode('', None, self)
+        self.created(self.root, False)
 
     def get_path_aggregator(self, http_path):
         path = http_path + '?'
@@ -36,88 +114,325 @@ class PathAggregator:
         resource = path_parts[0]
         if resource[0] == '/':
             resource = resource[1:]
+        with self.lock:
+            current_node = self.get_node(resource)
+            if not current_node.shared:
+                current_node.shared = True
+                self.changes.append({ 'op': 'path', 'path': resource })
+            if self.leaves is not None:
+                if current_node in self.leaves:
+                    self.leaves.move_to_end(current_node)
+                self.evict()
+            name = current_node.get_name()
+        return name_uuid(name), name
+
+    def get_node(self, resource):
         current_node = self.root
         for resource_part in resource.split('/'):
             current_node = current_node.get_child(resource_part)
-            self.counter += 1
-        if self.counter > 100:
-            self.root.compress()
-            self.counter = 0
-        return current_node.get_uuid(), current_node.get_name()
+        return current_node
+
+    def find_node(self, name):
+        current_node = self.root
+        for node_name in name.split('/')[1:]:
+            node = (current_node.child_nodes_by_string or NO_CHILDREN).get(node_name) or \
+                   (current_node.child_nodes_by_class or NO_CHILDREN).get(node_name)
+            if node is None:
+                return None
+            current_node = node
+        return current_node
+
+    def record_compression(self, node, group_name):
+        self.changes.append({ 'op': 'compress', 'path': node.get_name(), 'group': group_name })
+
+    #
+    # Node accounting, for the node ceiling and the exported metrics
+    #
+    def created(self, node, evictable):
+        self.nodes += 1
+        self.segment_bytes += sys.getsizeof(node.segment)
+        if evictable and self.leaves is not None:
+            self.leaves[node] = None
+
+    def released(self, node):
+        self.nodes -= 1
+        self.segment_bytes -= sys.getsizeof(node.segment)
+        if self.leaves is not None:
+            self.leaves.pop(node, None)
+
+    def evict(self):
+        while self.nodes > self.max_nodes and self.leaves:
+            node, _ = self.leaves.popitem(last=False)
+            parent = node.parent
+            parent.remove_child(node)
+            self.released(node)
+            self.evicted_nodes += 1
+            if parent.is_leaf() and parent.parent and parent.parent.child_nodes_by_string and \
+                    parent.parent.child_nodes_by_string.get(parent.segment) is parent:
+                self.leaves[parent] = None
+                self.leaves.move_to_end(parent, last=False)
+
+    def estimated_bytes(self):
+        return self.nodes * NODE_BYTES + self.segment_bytes
+
+    #
+    # Change log exchanged between replicas: paths that reached a new node and
+    # compressions. Applying a change is idempotent.
+    #
+    def take_changes(self):
+        with self.lock:
+            changes = self.changes
+            self.changes = []
+        return changes
+
+    def restore_changes(self, changes):
+        # Changes that could not be published, kept ahead of the newer ones
+        with self.lock:
+            self.changes = changes + self.changes
+
+    def apply_changes(self, changes):
+        with self.lock:
+            for change in changes:
+                if change.get('op') == 'path':
+                    self.get_node(change.get('path')).shared = True
+                elif change.get('op') == 'compress':
+                    node = self.find_node(change.get('path'))
+                    if node:
+                        node.compress(change.get('group'))
+            if self.leaves is not None:
+                self.evict()
+
+    def to_snapshot(self):
+        with self.lock:
+            return self.root.to_snapshot()
+
+    def load_snapshot(self, snapshot):
+        with self.lock:
+            self.reset()
+            self.root.load_snapshot(snapshot)
+            self.changes = []
+            if self.leaves is not None:
+                self.evict()
 
+#
+# Names and UUIDs are derived from the parent chain instead of being stored,
+# and child dicts are only allocated once a node has children.
+#
 class PathNode:
 
-    def __init__(self, name):
-        self.name = name
-        self.uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, name))
-        self.child_nodes_by_regexp = {}
-        self.child_nodes_by_string = {}
+    __slots__ = ('segment', 'parent', 'tree', 'child_nodes_by_string', 'child_nodes_by_class',
+                 'child_node_by_classes', 'child_classes', 'evicted_children', 'compressed', 'shared')
+
+    def __init__(self, segment, parent, tree):
+        self.segment = segment
+        self.parent = parent
+        self.tree = tree
+        self.child_nodes_by_string = None
+        self.child_nodes_by_class = None
+        self.child_node_by_classes = None
+        self.child_classes = ALL_CLASSES # Classes satisfied by every child ever added by string
+        self.evicted_children = None     # Names of evicted children, still counted for compression
         self.compressed = False
+        self.shared = False              # Already published to the change log
 
     def get_child(self, node_name):
-        for regexp, node in self.child_nodes_by_regexp.items():
-            if regexp.search(node_name):
+        if self.child_nodes_by_class:
+            node = self.get_child_by_classes(classify_segment(node_name))
+            if node:
                 return node
-        if node_name not in self.child_nodes_by_string:
-            self.child_nodes_by_string[node_name] = PathNode(self.name + '/' + node_name)
-        return self.child_nodes_by_string[node_name]
-
-    def compress(self):
-        for node in self.child_nodes_by_string.values():
-            node.compress()
-        for node in self.child_nodes_by_regexp.values():
-            node.compress()
-        if self.compressed:
-            return
-        if len(self.child_nodes_by_string) > 1000:
-            groups = [
-                { 'name': '<number>',              'regexp': re.compile(r"^[0-9]+$")                                                       },
-                { 'name': '<hexadecimal>',         'regexp': re.compile(r"^[0-9a-f]+$")                                                    },
-                { 'name': '<uuid>',                'regexp': re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$") },
-                { 'name': '<letters>',             'regexp': re.compile(r"^[A-Za-z]+$")                                                    },
-                { 'name': '<letters_and_numbers>', 'regexp': re.compile(r"^[A-Za-z0-9]+$")                                                 },
-                { 'name': '<anything>',            'regexp': re.compile(r"^.+$")                                                           },
-            ]
-            for group in groups:
-                group_name = group.get('name')
-                group_regexp = group.get('regexp')
-                use_group = True
-                for node_name in self.child_nodes_by_string:
-                    if not group_regexp.search(node_name):
-                        use_group = False
-                        break
-                if use_group:
-                    new_node = PathNode(self.name + '/' + group_name)
-                    self.child_nodes_by_regexp[group_regexp] = new_node
-                    for each_node in self.child_nodes_by_string.values():
-                        new_node.merge(each_node)
-                    self.child_nodes_by_string.clear()
-                    self.compressed = True
+        if self.child_nodes_by_string:
+            node = self.child_nodes_by_string.get(node_name)
+            if node is not None:
+                return node
+        node = self.add_child_by_string(node_name)
+        if self.compress():
+            return self.get_child(node_name)
+        return node
+
+    def get_child_by_classes(self, classes):
+        # Routing is memoized per classes bitmask, so it is a single dict lookup
+        if self.child_node_by_classes is None:
+            self.child_node_by_classes = {}
+        if classes not in self.child_node_by_classes:
+            self.child_node_by_classes[classes] = None
+            for group_name, node in self.child_nodes_by_class.items():
+                if classes & GROUP_CLASSES[group_name]:
+                    self.child_node_by_classes[classes] = node
                     break
+        return self.child_node_by_classes[classes]
 
+    def add_child_by_string(self, node_name):
+        classes = classify_segment(node_name)
+        if not classes & IDENTIFIER_CLASSES: # Identifiers are rarely repeated, interning them would only pin them
+            node_name = sys.intern(node_name)
+        node = PathNode(node_name, self, self.tree)
+        if self.child_nodes_by_string is None:
+            self.child_nodes_by_string = {}
+        self.child_nodes_by_string[node_name] = node
+        self.child_classes &= classes
+        if self.evicted_children:
+            self.evicted_children.discard(node_name)
+        self.became_parent()
+        self.tree.created(node, True)
+        return node
 
-    def merge(self, another_node):
-        for node_name, node in another_node.child_nodes_by_string.items():
-            if node_name in self.child_nodes_by_string:
-                self.child_nodes_by_string[node_name].merge(node)
-                self.child_nodes_by_string[node_name].compress()
-            else:
-                new_node = PathNode(self.name + '/' + node_name)
-                self.child_nodes_by_string[node_name] = new_node
-                new_node.merge(node)
-        for regexp, node in another_node.child_nodes_by_regexp.items():
-            if regexp in self.child_nodes_by_regexp:
-                self.child_nodes_by_regexp[regexp].merge(node)
-                self.child_nodes_by_regexp[regexp].compress()
+    def add_child_by_class(self, group_name):
+        node = PathNode(group_name, self, self.tree)
+        if self.child_nodes_by_class is None:
+            self.child_nodes_by_class = {}
+        self.child_nodes_by_class[group_name] = node
+        self.child_node_by_classes = None
+        self.became_parent()
+        self.tree.created(node, False)
+        return node
+
+    def became_parent(self):
+        if self.tree.leaves is not None:
+            self.tree.leaves.pop(self, None)
+
+    def remove_child(self, node):
+        del self.child_nodes_by_string[node.segment]
+        if not self.child_nodes_by_string:
+            self.child_nodes_by_string = None
+        if not self.compressed:
+            # Kept until the node is compressed, at most COMPRESS_THRESHOLD names
+            if self.evicted_children is None:
+                self.evicted_children = set()
+            self.evicted_children.add(node.segment)
+
+    def distinct_children(self):
+        # Children re-added after eviction are only counted once
+        return len(self.child_nodes_by_string or NO_CHILDREN) + len(self.evicted_children or ())
+
+    def is_leaf(self):
+        return not self.child_nodes_by_string and not self.child_nodes_by_class
+
+    def release(self):
+        for node in (self.child_nodes_by_string or NO_CHILDREN).values():
+            node.release()
+        for node in (self.child_nodes_by_class or NO_CHILDREN).values():
+            node.release()
+        self.tree.released(self)
+
+    #
+    # Collapses the children of this node only, once they cross the threshold.
+    # A group name forces the compression requested by another replica, in
+    # which case only the children matching that group are collapsed.
+    #
+    # Two replicas may compress the same node into different groups before
+    # seeing each other's change. Every replica then keeps the broader one,
+    # the latest in GROUPS, merging the narrower group into it, so they all
+    # end up on the same tree.
+    #
+    # Returns True if the node was compressed.
+    #
+    def compress(self, group_name=None):
+        if self.compressed and group_name is None:
+            return False
+        if group_name is None:
+            if self.distinct_children() <= COMPRESS_THRESHOLD:
+                return False
+            for group in GROUPS:
+                if self.child_classes & group.get('class'):
+                    nodes = self.child_nodes_by_string or NO_CHILDREN
+                    self.child_nodes_by_string = None
+                    self.child_classes = ALL_CLASSES
+                    self.evicted_children = None
+                    self.collapse(group.get('name'), nodes)
+                    self.tree.record_compression(self, group.get('name'))
+                    return True
+            return False
+        narrower_nodes = {}
+        if self.compressed:
+            narrower_nodes = { name: node for name, node in (self.child_nodes_by_class or NO_CHILDREN).items()
+                               if GROUP_ORDER[name] < GROUP_ORDER[group_name] }
+            if not narrower_nodes:
+                return False
+            logger.info("Compressing '%s' into %s instead of %s, as done by another replica.",
+                        self.get_name(), group_name, ', '.join(narrower_nodes))
+            for name in narrower_nodes:
+                del self.child_nodes_by_class[name]
+            self.child_node_by_classes = None
+        group_class = GROUP_CLASSES[group_name]
+        matching_nodes = {}
+        remaining_nodes = {}
+        for node_name, node in (self.child_nodes_by_string or NO_CHILDREN).items():
+            if classify_segment(node_name) & group_class:
+                matching_nodes[node_name] = node
             else:
-                new_node = PathNode(self.name + '/' + node_name)
-                self.child_nodes_by_regexp[regexp] = new_node
-                new_node.merge(node)
+                remaining_nodes[node_name] = node
+        self.child_nodes_by_string = remaining_nodes or None
+        self.child_classes = ALL_CLASSES
+        for node_name in remaining_nodes:
+            self.child_classes &= classify_segment(node_name)
+        self.evicted_children = None
+        self.collapse(group_name, matching_nodes)
+        new_node = self.child_nodes_by_class[group_name]
+        for node in narrower_nodes.values():
+            new_node.merge(node)
+            node.release()
+        return True
+
+    def collapse(self, group_name, nodes):
+        new_node = (self.child_nodes_by_class or NO_CHILDREN).get(group_name)
+        if new_node is None:
+            new_node = self.add_child_by_class(group_name)
+        self.compressed = True
+        for each_node in nodes.values():
+            new_node.merge(each_node)
+            each_node.release()
+
+
+    def merge(self, another_node):
+        for node_name, node in (another_node.child_nodes_by_string or NO_CHILDREN).items():
+            child_node = (self.child_nodes_by_string or NO_CHILDREN).get(node_name)
+            if child_node is None:
+                child_node = self.add_child_by_string(node_name)
+            child_node.merge(node)
+        for group_name, node in (another_node.child_nodes_by_class or NO_CHILDREN).items():
+            child_node = (self.child_nodes_by_class or NO_CHILDREN).get(group_name)
+            if child_node is None:
+                child_node = self.add_child_by_class(group_name)
+            child_node.merge(node)
+        self.shared = self.shared or another_node.shared
+        self.compress()
+
+
+    def to_snapshot(self):
+        snapshot = {}
+        if self.child_nodes_by_string:
+            snapshot['s'] = { node_name: node.to_snapshot() for node_name, node in self.child_nodes_by_string.items() }
+        if self.child_nodes_by_class:
+            snapshot['c'] = { group_name: node.to_snapshot() for group_name, node in self.child_nodes_by_class.items() }
+        if self.compressed:
+            snapshot['z'] = 1
+        return snapshot
+
+
+    def load_snapshot(self, snapshot):
+        self.shared = True
+        self.compressed = bool(snapshot.get('z'))
+        for node_name, node_snapshot in snapshot.get('s', {}).items():
+            self.add_child_by_string(node_name).load_snapshot(node_snapshot)
+        for group_name, node_snapshot in snapshot.get('c', {}).items():
+            self.add_child_by_class(group_name).load_snapshot(node_snapshot)
 
 
     def get_uuid(self):
-        return self.uuid
+        return name_uuid(self.get_name())
 
 
     def get_name(self):
-        return self.name
+        segments = []
+        node = self
+        while node.parent is not None:
+            segments.append(node.segment)
+            node = node.parent
+        if not segments:
+            return ''
+        segments.reverse()
+        return '/' + '/'.join(segments)
+
+
+# Rough per node footprint: the node itself, its entries in the parent and LRU dicts
+NODE_BYTES = sys.getsizeof(PathNode('', None, None)) + 100
@@ -0,0 +1,128 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import datetime
+import json
+import time
+import uuid
+import zlib
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger()
+
+SNAPSHOT_CHUNK_SIZE = 8 * 1024 * 1024 # Keeps every chunk below the 16MB document limit
+CHANGES_OVERLAP = 60                  # Seconds re-read on every sync, covering clock skew and in-flight inserts
+SNAPSHOTS_RETENTION = 3600            # Snapshots of other replicas are kept at least this long
+
+#
+# Persists a PathAggregator in MongoDB and keeps replicas converging on the
+# same tree.
+#
+# The tree is periodically written as a zlib compressed snapshot, split in
+# chunks, and referenced by the 'latest' document once complete. Between
+# snapshots, each replica appends its own changes to a change log and
+# applies the changes of the other replicas, so no lock is held on the hot
+# path.
+#
+class PathAggregatorStore:
+
+    def __init__(self, path_aggregator, snapshots_collection, changes_collection, changes_retention=86400):
+        self.path_aggregator = path_aggregator
+        self.snapshots_collection = snapshots_collection
+        self.changes_collection = changes_collection
+        self.replica = str(uuid.uuid4())
+        self.synced_until = 0
+        self.applied_changes = {}
+        self.snapshots_collection.create_index([("snapshot", 1), ("chunk", 1)])
+        self.changes_collection.create_index([("timestamp", 1)])
+        self.changes_collection.create_index([("created", 1)], expireAfterSeconds=changes_retention)
+
+    def load(self):
+        latest = self.snapshots_collection.find_one({ "_id": "latest" })
+        if latest:
+            chunks = list(self.snapshots_collection.find({ "snapshot": latest.get("snapshot"), "chunk": { "$exists": True } }).sort("chunk", 1))
+            if len(chunks) == latest.get("chunks"):
+                data = b''.join(chunk.get("data") for chunk in chunks)
+                self.path_aggregator.load_snapshot(json.loads(zlib.decompress(data)))
+                self.synced_until = latest.get("timestamp")
+                logger.info('Loaded path aggregator snapshot %s (%d bytes).', latest.get("snapshot"), len(data))
+            else:
+                logger.warning('Incomplete path aggregator snapshot %s, replaying the change log only.', latest.get("snapshot"))
+        else:
+            logger.info('No path aggregator snapshot found, replaying the change log only.')
+        self.sync()
+
+    def sync(self):
+        changes = self.path_aggregator.take_changes()
+        if changes:
+            timestamp = time.time()
+            created = datetime.datetime.utcnow()
+            for change in changes:
+                change['replica'] = self.replica
+                change['timestamp'] = timestamp
+                change['created'] = created
+            try:
+                self.changes_collection.insert_many(changes, ordered=False)
+            except BulkWriteError as error:
+                # Ids are kept, so changes inserted by a partially applied attempt only fail as duplicates
+                if error.details.get('writeConcernErrors') or \
+                        any(write_error.get('code') != 11000 for write_error in error.details.get('writeErrors', [])):
+                    self.path_aggregator.restore_changes(changes)
+                    raise
+            except:
+                # Published on the next sync, otherwise the other replicas would never see them
+                self.path_aggregator.restore_changes(changes)
+                raise
+        started = time.time()
+        query = { "timestamp": { "$gte": self.synced_until - CHANGES_OVERLAP }, "replica": { "$ne": self.replica } }
+        remote_changes = []
+        for change in self.changes_collection.find(query).sort([("timestamp", 1), ("_id", 1)]):
+            if change.get("_id") not in self.applied_changes:
+                remote_changes.append(change)
+                self.applied_changes[change.get("_id")] = change.get("timestamp")
+        if remote_changes:
+            self.path_aggregator.apply_changes(remote_changes)
+            logger.info('Applied %d path aggregator changes from other replicas.', len(remote_changes))
+        self.synced_until = started
+        for change_id, timestamp in list(self.applied_changes.items()):
+            if timestamp < self.synced_until - CHANGES_OVERLAP:
+                del self.applied_changes[change_id]
+
+    def save_snapshot(self):
+        # Everything logged before the last sync is already in the tree
+        timestamp = self.synced_until
+        data = zlib.compress(json.dumps(self.path_aggregator.to_snapshot(), separators=(',', ':')).encode())
+        snapshot_id = str(uuid.uuid4())
+        chunks = []
+        for offset in range(0, max(len(data), 1), SNAPSHOT_CHUNK_SIZE):
+            chunks.append({
+                "_id": snapshot_id + '/' + str(len(chunks)),
+                "snapshot": snapshot_id,
+                "chunk": len(chunks),
+                "timestamp": timestamp,
+                "data": data[offset:offset + SNAPSHOT_CHUNK_SIZE]
+            })
+        for chunk in chunks:
+            self.snapshots_collection.insert_one(chunk)
+        self.snapshots_collection.replace_one({ "_id": "latest" },
+                                              { "snapshot": snapshot_id, "chunks": len(chunks), "timestamp": timestamp },
+                                              upsert=True)
+        # Other replicas may be writing their own snapshot, only drop the old ones
+        self.snapshots_collection.delete_many({ "snapshot": { "$ne": snapshot_id },
+                                                "chunk": { "$exists": True },
+                                                "timestamp": { "$lt": timestamp - SNAPSHOTS_RETENTION } })
+        logger.info('Saved path aggregator snapshot %s (%d bytes in %d chunks).', snapshot_id, len(data), len(chunks))
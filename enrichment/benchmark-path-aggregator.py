@@ -0,0 +1,128 @@
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Microbenchmark for PathAggregator lookups, followed by a check that
+# eviction churn alone never compresses a node.
+#
+# Usage: python benchmark-path-aggregator.py [lookups]
+#
+
+import re
+import sys
+import time
+import uuid
+import random
+from PathAggregator import PathAggregator, classify_segment
+
+
+REGEXPS = [
+    re.compile(r"^[0-9]+$"),
+    re.compile(r"^[0-9a-f]+$"),
+    re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"),
+    re.compile(r"^[A-Za-z]+$"),
+    re.compile(r"^[A-Za-z0-9]+$"),
+    re.compile(r"^.+$"),
+]
+
+
+def deep_paths(count):
+    # 32 levels, numeric ids every other level
+    paths = []
+    for _ in range(count):
+        parts = []
+        for level in range(16):
+            parts.append('level%d' % level)
+            parts.append(str(random.randint(0, 5000)))
+        paths.append('/host/GET/' + '/'.join(parts))
+    return paths
+
+
+def wide_paths(count):
+    # A few thousand siblings per level, collapsed into class children
+    paths = []
+    for _ in range(count):
+        paths.append('/host/GET/users/%d/devices/%s/tokens/%x' % (random.randint(0, 100000),
+                                                                  uuid.uuid4(),
+                                                                  random.randint(0, 2**40)))
+    return paths
+
+
+def walk(path_aggregator, http_path):
+    node = path_aggregator.root
+    for part in http_path[1:].split('/'):
+        node = node.get_child(part)
+    return node
+
+
+def measure(name, path_aggregator, paths):
+    for http_path in paths:
+        path_aggregator.get_path_aggregator(http_path)
+    segments = sum(http_path.count('/') for http_path in paths)
+
+    started = time.perf_counter()
+    for http_path in paths:
+        walk(path_aggregator, http_path)
+    routing = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for http_path in paths:
+        path_aggregator.get_path_aggregator(http_path)
+    lookups = time.perf_counter() - started
+
+    print('%-6s %8.2f us/lookup %8.3f us/segment (routing only), %8.2f us/lookup (get_path_aggregator)' % (
+        name, routing / len(paths) * 1e6, routing / segments * 1e6, lookups / len(paths) * 1e6))
+
+
+def measure_classifier(segments):
+    started = time.perf_counter()
+    for segment in segments:
+        classify_segment(segment)
+    classifier = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for segment in segments:
+        for regexp in REGEXPS:
+            if regexp.search(segment):
+                break
+    regexps = time.perf_counter() - started
+
+    print('classify_segment %.3f us/segment, regexp scan %.3f us/segment' % (
+        classifier / len(segments) * 1e6, regexps / len(segments) * 1e6))
+
+
+def check_eviction_churn(endpoints=200, rounds=8, max_nodes=100):
+    # Re-adding evicted children must not count them again towards COMPRESS_THRESHOLD
+    names = ['endpoint%s%s' % (chr(97 + i // 26 % 26), chr(97 + i % 26)) for i in range(endpoints)]
+    path_aggregator = PathAggregator(max_nodes)
+    for _ in range(rounds):
+        for name in names:
+            path_aggregator.get_path_aggregator('/svc/GET/' + name)
+    compressed = [name for name in names if path_aggregator.get_path_aggregator('/svc/GET/' + name)[1] != '/svc/GET/' + name]
+    assert not compressed, 'eviction churn compressed /svc/GET after %d evictions' % path_aggregator.evicted_nodes
+    print('eviction churn: %d evictions, no compression' % path_aggregator.evicted_nodes)
+
+
+if __name__ == "__main__":
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    random.seed(0)
+    measure('deep', PathAggregator(), deep_paths(lookups))
+    measure('wide', PathAggregator(), wide_paths(lookups))
+    segments = []
+    for http_path in wide_paths(lookups // 4) + deep_paths(lookups // 64):
+        segments.extend(http_path[1:].split('/'))
+    measure_classifier(segments)
+    check_eviction_churn()
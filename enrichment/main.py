@@ -24,9 +24,14 @@ import pika
 import time
 import random
 import uuid
+import zlib
 from PathAggregator import PathAggregator
+from PathAggregatorStore import PathAggregatorStore
+from AggregateCounters import AggregateCounters
+from RollupCounters import RollupCounters
 from flask import Flask
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_client import Gauge
 
 
 logger = logging.getLogger()
@@ -58,6 +63,12 @@ else:
 	rabbitmq_exchange = "http_enriched_records"
 logger.info('RabbitMQ exchange: %s', rabbitmq_exchange)
 
+if 'RABBITMQ_SHARDS' in os.environ:
+	rabbitmq_shards = int(os.environ['RABBITMQ_SHARDS'])
+else:
+	rabbitmq_shards = 64
+logger.info('RabbitMQ routing key shards: %d', rabbitmq_shards)
+
 if 'MONGO_URL' in os.environ:
 	mongo_url = os.environ['MONGO_URL']
 	logger.info('Using mongo URL: %s', mongo_url)
@@ -77,6 +88,72 @@ else:
 	mongo_http_records = 'http_records'
 logger.info('HTTP records collection is: %s', mongo_http_records)
 
+if 'MONGO_AGGREGATES' in os.environ:
+	mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+	mongo_aggregates = 'aggregates'
+logger.info('Aggregates collection is: %s', mongo_aggregates)
+
+if 'MONGO_ROLLUPS' in os.environ:
+	mongo_rollups = os.environ['MONGO_ROLLUPS']
+else:
+	mongo_rollups = 'rollups'
+logger.info('Rollups collection is: %s', mongo_rollups)
+
+if 'AGGREGATES_FLUSH_INTERVAL' in os.environ:
+	aggregates_flush_interval = int(os.environ['AGGREGATES_FLUSH_INTERVAL'])
+else:
+	aggregates_flush_interval = 5
+logger.info('Aggregate counters flush interval: %d seconds', aggregates_flush_interval)
+
+if 'BATCH_SIZE' in os.environ:
+	batch_size = int(os.environ['BATCH_SIZE'])
+else:
+	batch_size = 1
+logger.info('Enrichment batch size: %d records', batch_size)
+
+if 'BATCH_TIMEOUT_MS' in os.environ:
+	batch_timeout = float(os.environ['BATCH_TIMEOUT_MS']) / 1000
+else:
+	batch_timeout = 0.1
+logger.info('Enrichment batch timeout: %d milliseconds', batch_timeout * 1000)
+
+if 'MONGO_PATH_SNAPSHOTS' in os.environ:
+	mongo_path_snapshots = os.environ['MONGO_PATH_SNAPSHOTS']
+else:
+	mongo_path_snapshots = 'path_aggregator_snapshots'
+logger.info('Path aggregator snapshots collection is: %s', mongo_path_snapshots)
+
+if 'MONGO_PATH_CHANGES' in os.environ:
+	mongo_path_changes = os.environ['MONGO_PATH_CHANGES']
+else:
+	mongo_path_changes = 'path_aggregator_changes'
+logger.info('Path aggregator change log collection is: %s', mongo_path_changes)
+
+if 'PATH_CHANGES_RETENTION' in os.environ:
+	path_changes_retention = int(os.environ['PATH_CHANGES_RETENTION'])
+else:
+	path_changes_retention = 86400
+logger.info('Path aggregator change log retention: %d seconds', path_changes_retention)
+
+if 'PATH_SYNC_INTERVAL' in os.environ:
+	path_sync_interval = int(os.environ['PATH_SYNC_INTERVAL'])
+else:
+	path_sync_interval = 5
+logger.info('Path aggregator synchronization interval: %d seconds', path_sync_interval)
+
+if 'PATH_SNAPSHOT_INTERVAL' in os.environ:
+	path_snapshot_interval = int(os.environ['PATH_SNAPSHOT_INTERVAL'])
+else:
+	path_snapshot_interval = 300
+logger.info('Path aggregator snapshot interval: %d seconds', path_snapshot_interval)
+
+if 'PATH_AGGREGATOR_MAX_NODES' in os.environ:
+	path_aggregator_max_nodes = int(os.environ['PATH_AGGREGATOR_MAX_NODES'])
+else:
+	path_aggregator_max_nodes = 1000000
+logger.info('Path aggregator maximum nodes: %d', path_aggregator_max_nodes)
+
 
 service_ok = False
 records_processed = 0
@@ -84,7 +161,13 @@ flask_app = Flask(__name__)
 metrics = PrometheusMetrics(flask_app)
 counter = metrics.info('processed_records', 'Number of processed records')
 counter.set(0)
-path_aggregator = PathAggregator()
+path_aggregator = PathAggregator(path_aggregator_max_nodes)
+Gauge('path_aggregator_nodes', 'Number of nodes in the path aggregator tree.').set_function(lambda: path_aggregator.nodes)
+Gauge('path_aggregator_evicted_nodes', 'Number of path aggregator nodes evicted since startup.').set_function(lambda: path_aggregator.evicted_nodes)
+Gauge('path_aggregator_estimated_bytes', 'Estimated memory used by the path aggregator tree.').set_function(path_aggregator.estimated_bytes)
+path_aggregator_loaded = threading.Event()
+aggregate_counters = AggregateCounters()
+rollup_counters = RollupCounters()
 
 
 @flask_app.route('/healthcheck')
@@ -96,13 +179,24 @@ def healthcheck():
 		return 'NOK', 400
 
 
+#
+# The fanout exchange ignores the routing key, sharded detectors bind to a
+# slice of these values through an exchange of their own.
+#
+def routing_key(data):
+	aggregate_id = data.get('aggregate_id')
+	if aggregate_id:
+		return str(zlib.crc32(aggregate_id.encode()) % rabbitmq_shards)
+	return ''
+
+
 def publish_message(channel, data):
 	global service_ok
 	message = json.dumps(data)
 	logger.debug('Sending processed document to RabbitMQ: %s', message)
 	try:
 		channel.basic_publish(exchange=rabbitmq_exchange,
-							  routing_key='',
+							  routing_key=routing_key(data),
 							  body=message,
 							  properties=pika.BasicProperties(delivery_mode = 2))
 		service_ok = True
@@ -122,6 +216,17 @@ def insert_into_database(collection, data):
 		raise
 
 
+def insert_batch_into_database(collection, records):
+	global service_ok
+	logger.debug('Sending %d processed documents to MongoDB.', len(records))
+	try:
+		collection.insert_many(records, ordered=False)
+		service_ok = True
+	except:
+		logger.error('Error sending data to MongoDB.')
+		raise
+
+
 def enrich_data(data):
 	preffix = ''
 	if data.get('http_host'):
@@ -136,8 +241,54 @@ def enrich_data(data):
 	return data
 
 
+def parse_record(body):
+	try:
+		return enrich_data(json.loads(body))
+	except:
+		logger.exception('Discarding record that could not be enriched: %s', body[:1024])
+		return None
+
+
+def count_records(records):
+	# Only once the records are stored and published, so a redelivered batch is not counted twice
+	for data in records:
+		aggregate_counters.add(data['aggregate_id'], data['aggregated_http_path'])
+		rollup_counters.add(data['aggregate_id'], data.get('timestamp', time.time()), 'records')
+	counter.inc(len(records))
+
+
+def consume_batches(channel, collection):
+	global counter, records_processed
+	channel.basic_qos(prefetch_count=batch_size)
+	# Each batch is published and acknowledged as a single transaction, one round trip instead of a confirm per record
+	channel.tx_select()
+	records = []
+	for method, properties, body in channel.consume(queue=rabbitmq_queue, inactivity_timeout=batch_timeout):
+		if method:
+			data = parse_record(body)
+			if data is None:
+				# Rejected on its own, the batch transaction holds nothing else at this point
+				channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+				channel.tx_commit()
+			else:
+				if not records:
+					batch_started = time.monotonic()
+				records.append(data)
+				delivery_tag = method.delivery_tag
+		if records and (len(records) >= batch_size or time.monotonic() - batch_started >= batch_timeout):
+			insert_batch_into_database(collection, [dict(data) for data in records])
+			for data in records:
+				publish_message(channel, data)
+			channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+			channel.tx_commit()
+			count_records(records)
+			records_processed += len(records)
+			records = []
+
+
 def run_queue_listener():
 	global service_ok
+	path_aggregator_loaded.wait()
 	while True:
 
 		connected = False
@@ -152,26 +303,80 @@ def run_queue_listener():
 				logger.info('Waiting before retrying RabbitMQ connection...')
 				time.sleep(15)
 
+		mongo_client = None
 		try:
 			mongo_client = MongoClient(mongo_url)
 			database = mongo_client[mongo_database]
 			collection = database[mongo_http_records]
 			service_ok = True
 
-			def callback(channel, method, properties, body):
-				global counter, records_processed
-				data = json.loads(body)
-				data = enrich_data(data)
-				insert_into_database(collection, dict(data))
-				publish_message(channel, data)
-				counter.inc()
-				records_processed += 1
+			if batch_size > 1:
+				consume_batches(channel, collection)
+			else:
+				def callback(channel, method, properties, body):
+					global records_processed
+					data = parse_record(body)
+					if data is None:
+						return
+					insert_into_database(collection, dict(data))
+					publish_message(channel, data)
+					count_records([data])
+					records_processed += 1
 
-			channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
-			channel.start_consuming()
+				channel.basic_consume(queue=rabbitmq_queue, on_message_callback=callback, auto_ack=True)
+				channel.start_consuming()
 		except:
 			service_ok = False
 			logger.exception("Failure enriching records.")
+			# Unacknowledged deliveries are only requeued once the old connection is gone
+			try:
+				connection.close()
+			except:
+				pass
+			if mongo_client:
+				mongo_client.close()
+			time.sleep(15)
+
+
+def run_path_aggregator_sync():
+	store = None
+	while True:
+		try:
+			if not store:
+				mongo_client = MongoClient(mongo_url)
+				database = mongo_client[mongo_database]
+				store = PathAggregatorStore(path_aggregator,
+											database[mongo_path_snapshots],
+											database[mongo_path_changes],
+											path_changes_retention)
+			if not path_aggregator_loaded.is_set():
+				store.load()
+				path_aggregator_loaded.set()
+			next_snapshot = time.time() + path_snapshot_interval
+			while True:
+				time.sleep(path_sync_interval)
+				store.sync()
+				if time.time() >= next_snapshot:
+					store.save_snapshot()
+					next_snapshot = time.time() + path_snapshot_interval
+		except:
+			logger.exception("Failure synchronizing path aggregator.")
+			time.sleep(15)
+
+
+def run_aggregate_counters_flush():
+	while True:
+		try:
+			mongo_client = MongoClient(mongo_url)
+			database = mongo_client[mongo_database]
+			collection = database[mongo_aggregates]
+			rollups_collection = database[mongo_rollups]
+			while True:
+				time.sleep(aggregates_flush_interval)
+				aggregate_counters.flush(collection)
+				rollup_counters.flush(rollups_collection)
+		except:
+			logger.exception("Failure updating aggregate and rollup counters.")
 			time.sleep(15)
 
 
@@ -187,6 +392,10 @@ def run_report_records_processed():
 
 if __name__ == "__main__":
 	try:
+		path_aggregator_sync_thread = threading.Thread(target=run_path_aggregator_sync)
+		path_aggregator_sync_thread.start()
+		aggregate_counters_flush_thread = threading.Thread(target=run_aggregate_counters_flush)
+		aggregate_counters_flush_thread.start()
 		queue_listener_thread=threading.Thread(target=run_queue_listener)
 		queue_listener_thread.start()
 		report_records_processed_thread = threading.Thread(target=run_report_records_processed)
@@ -0,0 +1,98 @@
+#!/usr/local/bin/python
+
+#
+# Copyright 2020, Fernando Lemes da Silva
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import sys
+import logging
+from pymongo import MongoClient, UpdateOne
+import time
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.INFO)
+handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+
+if 'MONGO_URL' in os.environ:
+    mongo_url = os.environ['MONGO_URL']
+    logger.info('Using mongo URL: %s', mongo_url)
+else:
+    logger.fatal('Missing MONGO_URL environment variable.')
+    sys.exit()
+
+if 'MONGO_DATABASE' in os.environ:
+    mongo_database = os.environ['MONGO_DATABASE']
+else:
+    mongo_database = 'kubeowl'
+logger.info('Using mongo database: %s', mongo_database)
+
+if 'MONGO_HTTP_RECORDS' in os.environ:
+    mongo_http_records = os.environ['MONGO_HTTP_RECORDS']
+else:
+    mongo_http_records = 'http_records'
+logger.info('HTTP records collection is: %s', mongo_http_records)
+
+if 'MONGO_AGGREGATES' in os.environ:
+    mongo_aggregates = os.environ['MONGO_AGGREGATES']
+else:
+    mongo_aggregates = 'aggregates'
+logger.info('Aggregates collection is: %s', mongo_aggregates)
+
+
+try:
+    client = MongoClient(mongo_url)
+    database = client[mongo_database]
+    collection = database[mongo_http_records]
+    aggregates_collection = database[mongo_aggregates]
+except:
+    logger.exception('Failure connecting to database.')
+    sys.exit()
+
+
+#
+# Recomputes the per aggregate record counters from the stored records, e.g.
+# after importing records or when upgrading from a version without counters.
+# Counts added by enrichment while it runs may be overwritten, run it while idle.
+#
+try:
+    now = int(time.time())
+    pipeline = [
+        { "$group": {"_id": "$aggregate_id", "count": {"$sum": 1}, "aggregated_http_path": {"$first": "$aggregated_http_path"} } }
+    ]
+    operations = []
+    aggregate_ids = []
+    for aggregate in collection.aggregate(pipeline, allowDiskUse=True):
+        if aggregate.get('_id'):
+            aggregate_ids.append(aggregate.get('_id'))
+            operations.append(UpdateOne({ "_id": aggregate.get('_id') },
+                                        { "$set": { "count": aggregate.get('count'),
+                                                    "aggregated_http_path": aggregate.get('aggregated_http_path') },
+                                          "$max": { "last_seen": now } },
+                                        upsert=True))
+    if operations:
+        aggregates_collection.bulk_write(operations, ordered=False)
+    result = aggregates_collection.update_many({ "_id": { "$nin": aggregate_ids } },
+                                               { "$set": { "count": 0 } })
+    logger.info("Rebuilt counters of %d aggregates, %d without records.", len(operations), result.modified_count)
+except:
+    logger.exception('Failure rebuilding aggregate counters.')
+    sys.exit()